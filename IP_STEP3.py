@@ -2,13 +2,14 @@ import tkinter as tk
 from tkinter import filedialog, ttk, messagebox, simpledialog
 from PIL import Image, ImageTk
 import cv2
-import numpy as np
 import json
 import csv
 import os
 import ctypes
 from tqdm import tqdm
 import threading
+from align import TemplateAligner
+from scan import TemplateLayout, read_sheet
 
 class OMRApp:
     def __init__(self, root):
@@ -128,6 +129,7 @@ class OMRApp:
         self.image = None
         self.tk_image = None
         self.cv_image = None
+        self.aligner = None
 
     def check_password(self):
         # Function to check password before allowing access
@@ -225,17 +227,13 @@ class OMRApp:
             print("No QPSERIES region selected.")
             return
 
-        # Detect shaded options for QPSERIES region
-        qpseries_responses = self.detect_shaded_option_qp(self.cv_image[self.qpseries_region[1]:self.qpseries_region[3], self.qpseries_region[0]:self.qpseries_region[2]])
-
-        # Detect roll numbers
-        roll_number_responses = [self.detect_shaded_roll_number(self.cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.roll_number_regions]
-
-        # Detect shaded options for all cropped A1 regions
-        responses = [self.detect_shaded_option(self.cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.regions]
-
-        # Detect QBNO regions
-        qbno_responses = [self.detect_shaded_qbno(self.cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.qbno_regions]
+        # Read the loaded image with the regions drawn so far, exactly as scan.py would
+        try:
+            layout = self.current_layout(self.cv_image.shape)
+        except ValueError as e:
+            messagebox.showerror("Template Error", str(e))
+            return
+        qpseries_responses, roll_number_responses, qbno_responses, responses = read_sheet(self.cv_image, layout)
         
         # Ask the user where to save the CSV file
         output_csv = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
@@ -257,197 +255,9 @@ class OMRApp:
 
         print(f"Responses saved to {output_csv}")
 
-    def detect_shaded_qbno(self, cropped_image):
-        # Apply Gaussian blur to reduce noise
-        blurred_image = cv2.GaussianBlur(cropped_image, (9, 9), 0)
-        # Perform binary thresholding to detect filled regions (assuming QBNO numbers are filled)
-        _, binary_image = cv2.threshold(cropped_image, 25, 255, cv2.THRESH_BINARY_INV)
-
-        # Find contours
-        contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Calculate dimensions and regions for digits 0 to 9 (vertical)
-        height, width = cropped_image.shape
-        digit_regions = [
-            (0, 0, width, height // 10),  # Region for digit 0
-            (0, height // 10, width, 2 * height // 10),  # Region for digit 1
-            (0, 2 * height // 10, width, 3 * height // 10),  # Region for digit 2
-            (0, 3 * height // 10, width, 4 * height // 10),  # Region for digit 3
-            (0, 4 * height // 10, width, 5 * height // 10),  # Region for digit 4
-            (0, 5 * height // 10, width, 6 * height // 10),  # Region for digit 5
-            (0, 6 * height // 10, width, 7 * height // 10),  # Region for digit 6
-            (0, 7 * height // 10, width, 8 * height // 10),  # Region for digit 7
-            (0, 8 * height // 10, width, 9 * height // 10),  # Region for digit 8
-            (0, 9 * height // 10, width, height)  # Region for digit 9
-        ]
-
-        # Variables to keep track of detected digits
-        detected_digits = []
-
-        # Iterate through each digit region
-        for digit, (x1, y1, x2, y2) in enumerate(digit_regions):
-            digit_mask = np.zeros_like(binary_image)
-            cv2.rectangle(digit_mask, (x1, y1), (x2, y2), 255, -1)  # Create a mask for the current digit region
-
-            # Calculate the intersection of contours with the digit mask
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=digit_mask)
-
-            # Find contours in the intersection area
-            digit_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # If there are contours in the digit region, consider it marked
-            if digit_contours:
-                detected_digits.append(str(digit))  # Add detected digit (0-9) to list
-
-        # Determine the final response based on detected digits
-        if len(detected_digits) == 0:
-            return 'X'  # No digit marked
-     #   elif len(detected_digits) > 1:
-     #       return '*'  # Multiple digits marked
-        else:
-            return detected_digits[0]  # Return the detected digit
-
-    def detect_shaded_option(self, cropped_image):
-        # Apply Gaussian blur to reduce noise
-        blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
-
-        # Perform binary thresholding to detect filled bubbles (assuming options are filled)
-        _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
-
-        # Find contours
-        contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-        # Calculate dimensions and regions for options A, B, C, D
-        height, width = cropped_image.shape
-        option_width = width // 4
-        option_regions = [
-            (0, 0, option_width, height),           # Region for option A
-            (option_width, 0, 2*option_width, height), # Region for option B
-            (2*option_width, 0, 3*option_width, height), # Region for option C
-            (3*option_width, 0, width, height)        # Region for option D
-    ]
-
-        # Initialize a list to store detected options
-        detected_options = []
-
-        # Iterate over option regions
-        for idx, (x1, y1, x2, y2) in enumerate(option_regions):
-            option_mask = np.zeros_like(binary_image)
-            cv2.rectangle(option_mask, (x1, y1), (x2, y2), 255, -1)
-
-            # Calculate the intersection of contours with the option mask
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=option_mask)
-
-            # Find contours in the intersection area
-            option_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Analyze contours to avoid false positives
-            for contour in option_contours:
-                area = cv2.contourArea(contour)
-                if area > 80:  # Adjust area threshold according to your needs
-                    detected_options.append(chr(ord('A') + idx))
-                    break  # Stop checking contours for this option after detecting one
-
-        # Determine the final response based on detected options
-        if len(detected_options) == 0:
-            return 'X'  # No option marked
-        elif len(detected_options) > 1:
-            return '*'  # Multiple options marked
-        else:
-            return detected_options[0]  # Return the detected option
-
-    def detect_shaded_roll_number(self, cropped_image):
-        # Apply Gaussian blur to reduce noise
-        blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
-        # Perform binary thresholding to detect filled regions (assuming roll numbers are filled)
-        _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
-
-        # Define specific bounding boxes for each bubble
-        # You need to adjust these bounding boxes according to your actual bubble positions and sizes
-        bubble_regions = [
-           (0, 0, cropped_image.shape[1], cropped_image.shape[0] // 10), 
-           (0, cropped_image.shape[0] // 10, cropped_image.shape[1], 2 * cropped_image.shape[0] // 10), 
-           (0, 2 * cropped_image.shape[0] // 10, cropped_image.shape[1], 3 * cropped_image.shape[0] // 10), 
-           (0, 3 * cropped_image.shape[0] // 10, cropped_image.shape[1], 4 * cropped_image.shape[0] // 10), 
-           (0, 4 * cropped_image.shape[0] // 10, cropped_image.shape[1], 5 * cropped_image.shape[0] // 10), 
-           (0, 5 * cropped_image.shape[0] // 10, cropped_image.shape[1], 6 * cropped_image.shape[0] // 10), 
-           (0, 6 * cropped_image.shape[0] // 10, cropped_image.shape[1], 7 * cropped_image.shape[0] // 10), 
-           (0, 7 * cropped_image.shape[0] // 10, cropped_image.shape[1], 8 * cropped_image.shape[0] // 10), 
-           (0, 8 * cropped_image.shape[0] // 10, cropped_image.shape[1], 9 * cropped_image.shape[0] // 10), 
-           (0, 9 * cropped_image.shape[0] // 10, cropped_image.shape[1], cropped_image.shape[0])
-    ]
-
-        detected_digits = []
-
-        # Iterate through each bubble region
-        for digit, (x1, y1, x2, y2) in enumerate(bubble_regions):
-            # Create a mask for the current bubble region
-            bubble_mask = np.zeros_like(binary_image)
-            cv2.rectangle(bubble_mask, (x1, y1), (x2, y2), 255, -1)
-        
-            # Calculate the intersection of contours with the bubble mask
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=bubble_mask)
-        
-            # Find contours in the intersection area
-            bubble_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-            # Analyze contours to ensure they are sufficiently large to be considered filled
-            if bubble_contours:
-                for contour in bubble_contours:
-                    area = cv2.contourArea(contour)
-                    if area > 100:  # Adjust the area threshold according to your needs
-                         detected_digits.append(str(digit))
-                         break
-
-        # Determine the final response based on detected digits
-        if len(detected_digits) == 0:
-            return 'X'  # No digit marked
-        elif len(detected_digits) > 1:
-            return '*'  # Multiple digits marked
-        else:
-            return detected_digits[0]  # Return the detected digit
-    def detect_shaded_option_qp(self, cropped_image):
-        # Perform binary thresholding to detect white bubbles
-        _, binary_image = cv2.threshold(cropped_image, 50, 255, cv2.THRESH_BINARY_INV)
-
-        # Find contours
-        contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Calculate dimensions and regions for options A, B, C, D
-        height, width = cropped_image.shape
-        option_height = height // 4
-        option_regions = [
-            (0, 0, width, option_height),               # Region for option A
-            (0, option_height, width, 2*option_height), # Region for option B
-            (0, 2*option_height, width, 3*option_height), # Region for option C
-            (0, 3*option_height, width, height)         # Region for option D
-        ]
-
-        # Initialize a list to store detected options
-        detected_options = []
-
-        # Iterate over option regions
-        for idx, (x1, y1, x2, y2) in enumerate(option_regions):
-            option_mask = np.zeros_like(binary_image)
-            cv2.rectangle(option_mask, (x1, y1), (x2, y2), 255, -1)  # Create a mask for the current option region
-
-            # Calculate the intersection of contours with the option mask
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=option_mask)
-
-            # Find contours in the intersection area
-            option_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # If there are contours in the option region, consider it marked
-            if option_contours:
-                detected_options.append(chr(65 + idx))  # ('A', 'B', 'C', 'D')
-
-        # Determine the final response based on detected options
-        if len(detected_options) == 0:
-            return 'X'  # No option marked
-        elif len(detected_options) > 1:
-            return '*'  # Multiple options marked
-        else:
-            return detected_options[0]  # Single option marked
+    def current_layout(self, image_shape=None):
+        # Compile the regions drawn or loaded so far into the layout used for scanning
+        return TemplateLayout({'qpseries_region': self.qpseries_region, 'question_regions': self.regions, 'roll_number_regions': self.roll_number_regions, 'qbno_regions': self.qbno_regions}, image_shape)
 
     def save_template(self):
         template_file = filedialog.asksaveasfilename(defaultextension=".gs", filetypes=[("template files", "*.gs")])
@@ -489,6 +299,9 @@ class OMRApp:
             print("No output file selected.")
             return
 
+        # Compile the template once for the whole folder
+        layout = self.current_layout()
+
         self.loading_label.config(text="Scanning images, please wait...")
         self.loading_label.pack(pady=10)  # Show loading label
 
@@ -508,18 +321,12 @@ class OMRApp:
                 image_path = os.path.join(image_folder, image_file)
                 image_paths.append(image_path)
                 cv_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+                if cv_image is None:
+                    print(f"Failed to load image: {image_path}")
+                    continue
 
-                # Detect QPSERIES response
-                qpseries_response = self.detect_shaded_option_qp(cv_image[self.qpseries_region[1]:self.qpseries_region[3], self.qpseries_region[0]:self.qpseries_region[2]])
-
-                # Detect roll number responses
-                roll_number_responses = [self.detect_shaded_roll_number(cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.roll_number_regions]
-
-                # Detect question responses
-                question_responses = [self.detect_shaded_option(cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.regions]
-
-                # Detect QBNO regions
-                qbno_responses = [self.detect_shaded_qbno(cv_image[y:y+h, x:x+w]) for _, x, y, w, h in self.qbno_regions]
+                # Detect QPSERIES, roll number, QBNO and question responses in one pass
+                qpseries_response, roll_number_responses, qbno_responses, question_responses = read_sheet(cv_image, layout)
 
                 responses.append((qpseries_response, roll_number_responses, question_responses, qbno_responses))
                 processed_count += 1
@@ -562,45 +369,15 @@ class OMRApp:
         messagebox.showinfo("Success", "Images extracted successfully.")
 
     def align_images(self, template_path, image_path, max_features=10000, good_match_percent=100):
-        # Load template and image to align
-        template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        
-        if template is None or image is None:
-            messagebox.showerror("Error", f"Failed to load image or template: {image_path}")
+        # Template features are computed once and reused for every image in the run
+        if self.aligner is None or self.aligner.template_path != template_path:
+            self.aligner = TemplateAligner(template_path, max_features, good_match_percent)
+
+        # Align the image and save it back to the original image path
+        if not self.aligner.align_file(image_path):
+            messagebox.showerror("Error", f"Failed to align image: {image_path}")
             return False
-        
-        # Detect ORB features and compute descriptors.
-        orb = cv2.ORB_create(max_features)
-        keypoints1, descriptors1 = orb.detectAndCompute(template, None)
-        keypoints2, descriptors2 = orb.detectAndCompute(image, None)
-        
-        # Match features using a brute-force matcher
-        matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        matches = matcher.match(descriptors1, descriptors2)
-        
-       
-        # Sort matches by score
-        matches = sorted(matches, key=lambda x: x.distance)
-        
-        # Adjust good match selection based on the number of matches
-        num_good_matches = min(len(matches), max(1, int(len(matches) * good_match_percent)))
-        matches = matches[:num_good_matches]
-        
-        # Extract points for homography calculation
-        points1 = np.float32([keypoints1[match.queryIdx].pt for match in matches]).reshape(-1, 1, 2)
-        points2 = np.float32([keypoints2[match.trainIdx].pt for match in matches]).reshape(-1, 1, 2)
-        
-        # Find homography using RANSAC
-        h, _ = cv2.findHomography(points2, points1, cv2.RANSAC, 5.0)
-        
-        # Use homography to warp image
-        height, width = template.shape
-        aligned_image = cv2.warpPerspective(image, h, (width, height))
-        
-        # Save aligned image back to original image path
-        cv2.imwrite(image_path, aligned_image)
-        
+
        # print(f"Alignment complete. Aligned image saved at {image_path}")
         return True
 
@@ -640,8 +417,11 @@ class OMRApp:
              for image_file in image_files:
                  image_path = os.path.join(image_dir, image_file)
                  try:
-                    self.align_images(template_path, image_path)
-                    aligned_count += 1
+                    if self.align_images(template_path, image_path):
+                        aligned_count += 1
+                 except ValueError as e:
+                    messagebox.showerror("Error", str(e))
+                    return
                  except Exception as e:
                     print(f"Error aligning {image_path}: {str(e)}")
 
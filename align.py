@@ -1,51 +1,581 @@
 import cv2
 import os
+import csv
+import time
+import hashlib
+import argparse
+import multiprocessing
 import numpy as np
 from tqdm import tqdm
+from manifest import ImageManifest, file_signature
+from loader import prefetch_images
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+MATCHERS = ('bf', 'knn', 'lsh')
+FLANN_INDEX_LSH = 6
+REJECT_FILE = 'alignment_rejects.csv'
+ALIGNMENT_MARKER = 'alignment_done.txt'
+
+
+def homography_quality(h, mask, sheet_points, template_points):
+    # RANSAC inlier count and ratio, and RMS distance in template pixels between the inlier
+    # template points and their sheet points mapped through h
+    inliers = mask.ravel().astype(bool)
+    if not inliers.any():
+        return 0, 0.0, 0.0
+    projected = cv2.perspectiveTransform(sheet_points[inliers].reshape(-1, 1, 2), h).reshape(-1, 2)
+    error = np.sqrt(np.mean(np.sum((projected - template_points[inliers].reshape(-1, 2)) ** 2, axis=1)))
+    return int(inliers.sum()), float(inliers.mean()), float(error)
+
+
+def empty_stats(method):
+    # estimate() statistics before anything is found; estimate() fills them in as it gets further
+    return {'homography': None, 'method': method, 'keypoints': 0, 'matches': 0, 'inliers': 0,
+            'inlier_ratio': 0.0, 'reproj_error': 0.0, 'reject_reason': None, 'detect_ms': 0.0, 'match_ms': 0.0, 'ransac_ms': 0.0}
+
+
+class TemplateAligner:
+    def __init__(self, template_path, max_features=10000, good_match_percent=100, use_cache=True, scale=1,
+                 matcher='bf', max_matches=None, ratio=0.75, min_inliers=20, min_inlier_ratio=0.5, max_reproj_error=2.5):
+        if matcher not in MATCHERS:
+            raise ValueError(f"Unknown matcher '{matcher}', expected one of: {', '.join(MATCHERS)}")
+        self.template_path = template_path
+        self.max_features = max_features
+        self.good_match_percent = good_match_percent
+        self.scale = scale
+        self.backend = matcher
+        self.max_matches = max_matches
+        self.ratio = ratio
+        self.min_inliers = min_inliers
+        self.min_inlier_ratio = min_inlier_ratio
+        self.max_reproj_error = max_reproj_error
+        self.orb = cv2.ORB_create(max_features)
+        self.template_shape = None
+        self.template_points = None
+        self.template_descriptors = None
+        self.load_features(use_cache)
+        self.matcher = self.create_matcher()
+
+    def __getstate__(self):
+        # ORB and matcher objects cannot be pickled; they are rebuilt on the worker side
+        state = self.__dict__.copy()
+        del state['orb'], state['matcher']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.orb = cv2.ORB_create(self.max_features)
+        self.matcher = self.create_matcher()
+
+    def create_matcher(self):
+        if self.backend == 'bf':
+            return cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        if self.backend == 'knn':
+            return cv2.BFMatcher(cv2.NORM_HAMMING)
+        # LSH index over the template descriptors, built once and queried with each sheet's descriptors
+        matcher = cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1),
+                                        dict(checks=50))
+        matcher.add([self.template_descriptors])
+        matcher.train()
+        return matcher
+
+    def cache_path(self):
+        # Stored next to the template so every run against it can reuse the features
+        base = os.path.splitext(self.template_path)[0]
+        if self.scale == 1:
+            return base + '.orb.npz'
+        return f'{base}.x{self.scale}.orb.npz'
+
+    def detect(self, image):
+        # Features are found on a 1/scale copy of the sheet and their coordinates mapped back to
+        # full resolution, so the homography always applies to the full-resolution image
+        if self.scale == 1:
+            keypoints, descriptors = self.orb.detectAndCompute(image, None)
+            return np.float32([kp.pt for kp in keypoints]).reshape(-1, 2), descriptors
+        height, width = image.shape
+        small = cv2.resize(image, (width // self.scale, height // self.scale), interpolation=cv2.INTER_AREA)
+        keypoints, descriptors = self.orb.detectAndCompute(small, None)
+        ratio = np.float32([width / small.shape[1], height / small.shape[0]])
+        points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+        return (points + 0.5) * ratio - 0.5, descriptors
+
+    def load_features(self, use_cache=True):
+        template_hash = file_hash(self.template_path)
+        cache_file = self.cache_path()
+        if use_cache and os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    if (str(cached['template_hash']) == template_hash and int(cached['max_features']) == self.max_features
+                            and int(cached['scale']) == self.scale):
+                        self.template_shape = tuple(int(v) for v in cached['template_shape'])
+                        self.template_points = cached['points']
+                        self.template_descriptors = cached['descriptors']
+                        return
+            except (OSError, KeyError, ValueError) as e:
+                print(f'Ignoring unreadable feature cache {cache_file}: {e}')
+
+        template = cv2.imread(self.template_path, cv2.IMREAD_GRAYSCALE)
+        if template is None:
+            raise ValueError(f'Failed to load template image: {self.template_path}')
+        points, descriptors = self.detect(template)
+        if descriptors is None:
+            raise ValueError(f'No features found in template: {self.template_path}')
+        self.template_shape = template.shape
+        self.template_points = points
+        self.template_descriptors = descriptors
+
+        if use_cache:
+            tmp_file = cache_file + '.tmp'
+            try:
+                with open(tmp_file, 'wb') as f:
+                    np.savez(f, template_hash=template_hash, max_features=self.max_features, scale=self.scale,
+                             template_shape=np.array(self.template_shape), points=self.template_points,
+                             descriptors=self.template_descriptors)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f'Could not write feature cache {cache_file}: {e}')
+
+    def match(self, descriptors):
+        # Returns template indices, sheet indices and distances of the candidate matches
+        if self.backend == 'bf':
+            matches = [(m.queryIdx, m.trainIdx, m.distance) for m in self.matcher.match(self.template_descriptors, descriptors)]
+        elif self.backend == 'knn':
+            matches = [(m[0].queryIdx, m[0].trainIdx, m[0].distance)
+                       for m in self.matcher.knnMatch(self.template_descriptors, descriptors, k=2)
+                       if len(m) == 2 and m[0].distance < self.ratio * m[1].distance]
+        else:
+            # The index holds the template, so here the sheet is the query side
+            matches = [(m[0].trainIdx, m[0].queryIdx, m[0].distance)
+                       for m in self.matcher.knnMatch(descriptors, k=2)
+                       if len(m) == 2 and m[0].distance < self.ratio * m[1].distance]
+        matches = np.array(matches, dtype=np.float64).reshape(-1, 3)
+        return matches[:, 0].astype(np.intp), matches[:, 1].astype(np.intp), matches[:, 2]
+
+    def select(self, distances):
+        # Indices of the best matches, closest first: good_match_percent of them, at most max_matches
+        count = len(distances)
+        keep = min(count, max(1, int(count * self.good_match_percent)))
+        if self.max_matches:
+            keep = min(keep, self.max_matches)
+        if keep < count:
+            best = np.argpartition(distances, keep - 1)[:keep]
+            return best[np.argsort(distances[best], kind='stable')]
+        return np.argsort(distances, kind='stable')
+
+    def estimate(self, image):
+        # Homography (None when alignment fails) and per-sheet match statistics
+        stats = empty_stats('orb')
+        start = time.perf_counter()
+        points, descriptors = self.detect(image)
+        stats['detect_ms'] = (time.perf_counter() - start) * 1000
+        if descriptors is None:
+            return stats
+        stats['keypoints'] = len(points)
+
+        start = time.perf_counter()
+        template_idx, sheet_idx, distances = self.match(descriptors)
+        best = self.select(distances)
+        stats['match_ms'] = (time.perf_counter() - start) * 1000
+        stats['matches'] = len(best)
+        if len(best) < 4:
+            return stats
+
+        start = time.perf_counter()
+        points1 = self.template_points[template_idx[best]].reshape(-1, 1, 2)
+        points2 = points[sheet_idx[best]].reshape(-1, 1, 2)
+        h, mask = cv2.findHomography(points2, points1, cv2.RANSAC, 5.0 * self.scale)
+        stats['ransac_ms'] = (time.perf_counter() - start) * 1000
+        if h is None:
+            return stats
+        stats['homography'] = h
+        stats['inliers'], stats['inlier_ratio'], stats['reproj_error'] = homography_quality(h, mask, points2, points1)
+        stats['reject_reason'] = self.check_quality(stats)
+        return stats
+
+    def check_quality(self, stats):
+        # Why the homography should not be trusted, or None. RANSAC's threshold grows with the
+        # detection scale, so the reprojection limit does too.
+        if stats['inliers'] < self.min_inliers:
+            return f"{stats['inliers']} inliers (minimum {self.min_inliers})"
+        if stats['inlier_ratio'] < self.min_inlier_ratio:
+            return f"inlier ratio {stats['inlier_ratio']:.2f} (minimum {self.min_inlier_ratio})"
+        if stats['reproj_error'] > self.max_reproj_error * self.scale:
+            return f"reprojection error {stats['reproj_error']:.2f} px (maximum {self.max_reproj_error * self.scale})"
+        return None
+
+    def find_homography(self, image):
+        return self.estimate(image)['homography']
+
+    def warp(self, image, h):
+        height, width = self.template_shape
+        return cv2.warpPerspective(image, h, (width, height))
+
+    def align_file(self, image_path, image=None, stats=None):
+        # stats, if given, is filled in with the estimate() statistics for this sheet
+        if image is None:
+            image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print(f'Failed to load image: {image_path}')
+            return False
+        estimate = self.estimate(image)
+        if stats is not None:
+            stats.update(estimate)
+        h = estimate['homography']
+        if h is None:
+            print(f'Failed to align image: {image_path}')
+            return False
+        if estimate['reject_reason']:
+            print(f"Rejected image: {image_path} ({estimate['reject_reason']})")
+            return False
+        cv2.imwrite(image_path, self.warp(image, h))
+        return True
+
+
+def find_blobs(image, min_area=150):
+    # Solid dark blobs of an Otsu-thresholded sheet: (width, height, area) rows and their centres
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    _, _, stats, centres = cv2.connectedComponentsWithStats(binary)
+    sizes = stats[1:, 2:5].astype(np.float64)
+    centres = centres[1:]
+    solid = (sizes[:, 2] >= min_area) & (sizes[:, 2] >= 0.6 * sizes[:, 0] * sizes[:, 1])
+    return sizes[solid], centres[solid]
+
+
+def mark_kinds(sizes):
+    # Corner squares are about as wide as they are tall; timing marks are short horizontal dashes
+    aspect = sizes[:, 0] / sizes[:, 1]
+    return (aspect > 0.75) & (aspect < 1.33), (aspect > 1.8) & (aspect < 4.5)
+
+
+def nearest_to_corners(points, width, height):
+    # Index of the point closest to each image corner, clockwise from top-left
+    corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+    return np.linalg.norm(points[None, :, :] - corners[:, None, :], axis=2).argmin(axis=1)
+
+
+class FiducialAligner(TemplateAligner):
+    # Aligns on the printed marks instead of ORB features. The square nearest each corner of the
+    # sheet gives a coarse homography, which is refined on the timing marks down both edges. The
+    # marks are located once on the template; sheets whose marks are not found fall back to ORB.
+    def __init__(self, template_path, min_marks=20, **kwargs):
+        super().__init__(template_path, **kwargs)
+        self.min_marks = min_marks
+        self.corner_marks = None
+        self.timing_marks = None
+        self.square_area = None
+        self.mark_area = None
+        self.tolerance = None
+        self.load_marks()
+
+    def load_marks(self):
+        template = cv2.imread(self.template_path, cv2.IMREAD_GRAYSCALE)
+        if template is None:
+            raise ValueError(f'Failed to load template image: {self.template_path}')
+        height, width = template.shape
+        sizes, centres = find_blobs(template)
+        squares, dashes = mark_kinds(sizes)
+        # Timing marks run down the outer edges of the sheet
+        dashes &= (centres[:, 0] < 0.15 * width) | (centres[:, 0] > 0.85 * width)
+        if squares.sum() < 4 or dashes.sum() < self.min_marks:
+            raise ValueError(f'No corner squares and timing marks found in template: {self.template_path}')
+        corners = nearest_to_corners(centres[squares], width, height)
+        if len(set(corners)) < 4:
+            raise ValueError(f'No corner squares and timing marks found in template: {self.template_path}')
+        self.corner_marks = centres[squares][corners]
+        self.square_area = float(np.median(sizes[squares][corners, 2]))
+        self.timing_marks = centres[dashes]
+        self.mark_area = float(np.median(sizes[dashes, 2]))
+        # A mark may be matched at most a third of the way to its neighbour in the column
+        left = np.sort(centres[dashes & (centres[:, 0] < width / 2), 1])
+        self.tolerance = float(np.median(np.diff(left))) / 3 if len(left) > 1 else 10.0
+
+    def estimate_marks(self, image):
+        stats = empty_stats('fiducial')
+        start = time.perf_counter()
+        sizes, centres = find_blobs(image)
+        squares, dashes = mark_kinds(sizes)
+        squares &= (sizes[:, 2] > 0.5 * self.square_area) & (sizes[:, 2] < 2 * self.square_area)
+        dashes &= (sizes[:, 2] > 0.5 * self.mark_area) & (sizes[:, 2] < 2 * self.mark_area)
+        stats['detect_ms'] = (time.perf_counter() - start) * 1000
+        stats['keypoints'] = int(squares.sum() + dashes.sum())
+        if squares.sum() < 4 or dashes.sum() < self.min_marks:
+            return stats
+
+        start = time.perf_counter()
+        height, width = image.shape
+        corners = nearest_to_corners(centres[squares], width, height)
+        if len(set(corners)) < 4:
+            return stats
+        sheet_corners = centres[squares][corners]
+        coarse = cv2.getPerspectiveTransform(self.corner_marks.astype(np.float32), sheet_corners.astype(np.float32))
+        predicted = cv2.perspectiveTransform(self.timing_marks.reshape(-1, 1, 2), coarse).reshape(-1, 2)
+        # Pair each predicted timing mark with the nearest dash, keeping only mutual nearest pairs
+        sheet_marks = centres[dashes]
+        distances = np.linalg.norm(predicted[:, None, :] - sheet_marks[None, :, :], axis=2)
+        nearest = distances.argmin(axis=1)
+        paired = ((distances[np.arange(len(predicted)), nearest] < self.tolerance)
+                  & (distances.argmin(axis=0)[nearest] == np.arange(len(predicted))))
+        stats['match_ms'] = (time.perf_counter() - start) * 1000
+        stats['matches'] = int(paired.sum()) + 4
+        if paired.sum() < self.min_marks:
+            return stats
+
+        start = time.perf_counter()
+        template_points = np.vstack([self.corner_marks, self.timing_marks[paired]]).reshape(-1, 1, 2)
+        sheet_points = np.vstack([sheet_corners, sheet_marks[nearest[paired]]]).reshape(-1, 1, 2)
+        h, mask = cv2.findHomography(sheet_points, template_points, cv2.RANSAC, 3.0)
+        stats['ransac_ms'] = (time.perf_counter() - start) * 1000
+        # An upside-down sheet can still pair its marks; the homography would flip the axes
+        if h is None or h[0, 0] <= 0 or h[1, 1] <= 0:
+            return stats
+        stats['homography'] = h
+        stats['inliers'], stats['inlier_ratio'], stats['reproj_error'] = homography_quality(h, mask, sheet_points, template_points)
+        stats['reject_reason'] = self.check_quality(stats)
+        return stats
+
+    def estimate(self, image):
+        stats = self.estimate_marks(image)
+        if stats['homography'] is None or stats['reject_reason']:
+            stats = super().estimate(image)
+        return stats
+
+
+_aligners = {}
+
+
+def get_aligner(template_path, max_features=10000, good_match_percent=100, scale=1, matcher='bf', max_matches=None):
+    key = (template_path, max_features, good_match_percent, scale, matcher, max_matches)
+    if key not in _aligners:
+        _aligners[key] = TemplateAligner(template_path, max_features, good_match_percent, scale=scale,
+                                         matcher=matcher, max_matches=max_matches)
+    return _aligners[key]
+
 
 def align_images(template_path, image_path, max_features=10000, good_match_percent=100):
-    template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    if template is None or image is None:
-        print(f'Failed to load image: {image_path}')
-        return False
-    orb = cv2.ORB_create(max_features)
-    keypoints1, descriptors1 = orb.detectAndCompute(template, None)
-    keypoints2, descriptors2 = orb.detectAndCompute(image, None)
-    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = matcher.match(descriptors1, descriptors2)
-    matches = sorted(matches, key=lambda x: x.distance)
-    num_good_matches = min(len(matches), max(1, int(len(matches) * good_match_percent)))
-    matches = matches[:num_good_matches]
-    points1 = np.float32([keypoints1[match.queryIdx].pt for match in matches]).reshape(-1, 1, 2)
-    points2 = np.float32([keypoints2[match.trainIdx].pt for match in matches]).reshape(-1, 1, 2)
-    h, _ = cv2.findHomography(points2, points1, cv2.RANSAC, 5.0)
-    height, width = template.shape
-    aligned_image = cv2.warpPerspective(image, h, (width, height))
-    cv2.imwrite(image_path, aligned_image)
-    return True
+    return get_aligner(template_path, max_features, good_match_percent).align_file(image_path)
 
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 3:
-        print("Usage: python align.py <template_image> <image_dir>")
-        sys.exit(1)
-    template_image = sys.argv[1]
-    image_dir = sys.argv[2]
 
-    # Recursively collect all F.jpg files
+def find_image_files(image_dir):
     image_files = []
     for root, dirs, files in os.walk(image_dir):
         for file in files:
             if file.lower().endswith('f.jpg'):
                 image_files.append(os.path.join(root, file))
+    return image_files
+
+
+def init_cv2_worker():
+    # Pool initializer step shared by the align and scan workers. One process per core already;
+    # keep OpenCV from spawning its own threads on top.
+    cv2.setNumThreads(1)
+
+
+_worker_aligner = None
+
+
+def _init_worker(aligner):
+    global _worker_aligner
+    init_cv2_worker()
+    _worker_aligner = aligner
+
+
+def _align_file(aligner, image_path, image=None):
+    stats = {}
+    start = time.perf_counter()
+    ok = aligner.align_file(image_path, image, stats)
+    stats['total_ms'] = (time.perf_counter() - start) * 1000
+    stats.pop('homography', None)
+    return image_path, ok, stats
+
+
+def _align_worker(image_path):
+    return _align_file(_worker_aligner, image_path)
+
+
+def align_files(aligner, image_files, workers=1, manifest=None, prefetch=8, prefetch_mb=512):
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(aligner,))
+        outcomes = pool.imap(_align_worker, image_files)
+    else:
+        # Decode the next images on background threads while the current one is aligned
+        pool = None
+        outcomes = (_align_file(aligner, image_file, image)
+                    for image_file, image in prefetch_images(image_files, prefetch, prefetch_mb))
+    results = []
+    try:
+        for image_file, ok, stats in tqdm(outcomes, total=len(image_files)):
+            if manifest is not None:
+                record_alignment(manifest, image_file, ok, stats)
+            results.append((image_file, ok, stats))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return results
+
+
+def adopt_marker(manifest, image_files, marker_file):
+    # A folder finished before the manifest existed is recorded as aligned as-is
+    if not manifest.existed and os.path.exists(marker_file):
+        print(f'{marker_file} found without a manifest; recording existing images as aligned.')
+        for image_file in image_files:
+            manifest.record(image_file, aligned=file_signature(image_file), align_status='ok')
+
+
+def pending_alignment(manifest, image_files):
+    # Only new or changed sheets are aligned. Rejected sheets stay in the reject queue until the
+    # file changes or alignment is forced.
+    pending = [image_file for image_file in image_files if not manifest.is_aligned(image_file)]
+    if len(pending) < len(image_files):
+        print(f'Skipping {len(image_files) - len(pending)} images already aligned.')
+    accepted = [image_file for image_file in pending if not manifest.is_rejected(image_file)]
+    if len(accepted) < len(pending):
+        print(f'Skipping {len(pending) - len(accepted)} images rejected by an earlier run.')
+    return accepted
+
+
+def record_alignment(manifest, image_file, ok, stats):
+    if ok:
+        manifest.record(image_file, aligned=file_signature(image_file), align_status='ok', **quality_fields(stats))
+    elif stats.get('reject_reason'):
+        manifest.record(image_file, rejected=file_signature(image_file), align_status='rejected',
+                        reject_reason=stats['reject_reason'], **quality_fields(stats))
+    else:
+        manifest.record(image_file, align_status='failed')
+
+
+def quality_fields(stats):
+    return {'inliers': stats['inliers'], 'inlier_ratio': round(stats['inlier_ratio'], 3),
+            'reproj_error': round(stats['reproj_error'], 2)}
+
+
+REJECT_FIELDS = ['image', 'reject_reason', 'inliers', 'inlier_ratio', 'reproj_error']
+
+
+def write_rejects(manifest, reject_csv):
+    # The reject queue is every sheet the manifest still lists as rejected, from this run or earlier
+    # ones; the CSV is rewritten each time and removed once the queue is empty
+    rejects = [entry for entry in manifest.entries.values() if entry.get('align_status') == 'rejected']
+    if not rejects:
+        if os.path.exists(reject_csv):
+            os.remove(reject_csv)
+        return 0
+    with open(reject_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REJECT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for entry in sorted(rejects, key=lambda entry: entry['image']):
+            writer.writerow(dict(entry, image=os.path.join(manifest.image_dir, entry['image'])))
+    return len(rejects)
+
+
+STATS_FIELDS = ['image', 'matcher', 'ok', 'method', 'keypoints', 'matches', 'inliers', 'inlier_ratio', 'reproj_error',
+                'reject_reason', 'detect_ms', 'match_ms', 'ransac_ms', 'total_ms']
+
+
+def write_stats(stats_csv, results, matcher):
+    with open(stats_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=STATS_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for image_file, ok, stats in results:
+            row = {field: round(value, 1) if isinstance(value, float) else value for field, value in stats.items()}
+            writer.writerow(dict(row, image=image_file, matcher=matcher, ok=int(ok)))
+
+
+def print_stats(results, label, fiducials=False):
+    timed = [stats for _, _, stats in results if 'match_ms' in stats]
+    if not timed:
+        return
+    mean = {field: np.mean([stats[field] for stats in timed]) for field in STATS_FIELDS[4:] if field != 'reject_reason'}
+    print(f"Alignment ({label}): {mean['matches']:.0f} matches, {mean['inliers']:.0f} inliers per sheet; "
+          f"detect {mean['detect_ms']:.0f} ms, match {mean['match_ms']:.0f} ms, RANSAC {mean['ransac_ms']:.0f} ms, "
+          f"total {mean['total_ms']:.0f} ms")
+    # With --fiducials, a sheet aligned with ORB is one whose marks were not found
+    fallbacks = sum(1 for stats in timed if stats['method'] == 'orb')
+    if fiducials and fallbacks:
+        print(f"Fiducial marks not found on {fallbacks} sheet(s); those were aligned with ORB")
+
+
+def add_aligner_arguments(parser):
+    # Aligner options shared by align.py and the scripts that align with --align
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4], default=1,
+                        help='detect features on a 1/scale copy of each sheet; the warp stays full resolution (default: 1)')
+    parser.add_argument('--matcher', choices=MATCHERS, default='bf',
+                        help='bf: cross-checked brute force; knn: brute force with ratio test; lsh: LSH index over the template (default: bf)')
+    parser.add_argument('--max-matches', type=int, help='keep only this many of the closest matches for RANSAC')
+    parser.add_argument('--ratio', type=float, default=0.75, help='ratio test threshold for knn and lsh (default: 0.75)')
+    parser.add_argument('--fiducials', action='store_true',
+                        help='align on the printed corner squares and timing marks, using ORB only when they are not found')
+    parser.add_argument('--min-inlier-ratio', type=float, default=0.5,
+                        help='reject sheets whose RANSAC inlier ratio is below this (default: 0.5)')
+    parser.add_argument('--max-reproj-error', type=float, default=2.5,
+                        help='reject sheets whose RMS inlier reprojection error exceeds this many pixels per --scale step (default: 2.5)')
+
+
+def aligner_from_args(args, template_image):
+    # The aligner described by the add_aligner_arguments() options
+    aligner_class = FiducialAligner if args.fiducials else TemplateAligner
+    return aligner_class(template_image, scale=args.scale, matcher=args.matcher, max_matches=args.max_matches,
+                         ratio=args.ratio, min_inlier_ratio=args.min_inlier_ratio, max_reproj_error=args.max_reproj_error)
+
+
+if __name__ == "__main__":
+    import sys
+    parser = argparse.ArgumentParser(description='Align OMR sheets (*F.jpg) to a template image.')
+    parser.add_argument('template_image')
+    parser.add_argument('image_dir')
+    parser.add_argument('--workers', type=int, default=1, help='number of alignment processes (default: 1)')
+    parser.add_argument('--force', action='store_true', help='realign images the manifest already lists as aligned')
+    add_aligner_arguments(parser)
+    parser.add_argument('--reject-csv', help=f'where to list rejected sheets (default: <image_dir>/{REJECT_FILE})')
+    parser.add_argument('--stats-csv', help='write per-sheet match counts, inliers and timings to this CSV')
+    parser.add_argument('--prefetch', type=int, default=8, help='images to read and decode ahead in single-process mode (0 disables)')
+    parser.add_argument('--prefetch-mb', type=int, default=512, help='memory ceiling for prefetched images in MB (default: 512)')
+    args = parser.parse_args()
+    template_image = args.template_image
+    image_dir = args.image_dir
+    marker_file = os.path.join(image_dir, ALIGNMENT_MARKER)
+
+    # Recursively collect all F.jpg files
+    image_files = find_image_files(image_dir)
+
+    manifest = ImageManifest(image_dir)
+    if not args.force:
+        adopt_marker(manifest, image_files, marker_file)
+        image_files = pending_alignment(manifest, image_files)
+
+    try:
+        aligner = aligner_from_args(args, template_image)
+    except ValueError as e:
+        print(f'Error: {e}')
+        sys.exit(1)
 
-    print(f'Aligning {len(image_files)} images...')
-    for image_file in tqdm(image_files):
-        align_images(template_image, image_file)
+    print(f'Aligning {len(image_files)} images with {max(1, args.workers)} worker(s)...')
+    results = align_files(aligner, image_files, args.workers, manifest, args.prefetch, args.prefetch_mb)
+    manifest.close()
+    failed = [image_file for image_file, ok, stats in results if not ok and not stats.get('reject_reason')]
+    rejected = [image_file for image_file, ok, stats in results if stats.get('reject_reason')]
+    reject_csv = args.reject_csv or os.path.join(image_dir, REJECT_FILE)
+    queued = write_rejects(manifest, reject_csv)
+    if args.stats_csv:
+        write_stats(args.stats_csv, results, args.matcher)
 
     # Create alignment done marker in the base directory
-    with open(os.path.join(image_dir, 'alignment_done.txt'), 'w') as f:
+    with open(marker_file, 'w') as f:
         f.write('Alignment complete.')
 
-    print('Alignment complete.')
\ No newline at end of file
+    print(f'Successful: {len(results) - len(failed) - len(rejected)}')
+    print(f'Failed: {len(failed)}')
+    for image_file in failed:
+        print(f'  {image_file}')
+    print(f'Rejected: {len(rejected)}')
+    if queued:
+        print(f'{queued} rejected sheet(s) listed in {reject_csv}; scan.py skips them')
+    print_stats(results, 'fiducials' if args.fiducials else args.matcher, args.fiducials)
+    print('Alignment complete.')
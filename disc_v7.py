@@ -1,221 +1,602 @@
+import os
+import sys
+import csv
+import math
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
 import pandas as pd
-import tkinter as tk
-import tkinter.messagebox as mb
-from tkinter import simpledialog, filedialog
 import re
+from collections import Counter
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Font, Border, Side
 
+try:
+    import pyarrow  # noqa: F401
+    CACHE_SUFFIX = '.cache.feather'
+except ImportError:
+    CACHE_SUFFIX = '.cache.pkl'
+
+ANSWER_COLUMN = re.compile(r'A\d+$')
+EXCEL_MAX_ROWS = 1048576
+# Peak memory of an in-memory comparison per byte of CSV input, measured on 150-question files
+MEMORY_PER_BYTE = 8
+
+def result_dtypes(columns):
+    # ROLLNO and QBNO as text so leading zeros survive; answer columns hold a handful of codes
+    dtypes = {}
+    for column in columns:
+        name = str(column).strip()
+        if name in ('ROLLNO', 'QBNO'):
+            dtypes[column] = str
+        elif name == 'QPSERIES' or ANSWER_COLUMN.match(name):
+            dtypes[column] = 'category'
+    return dtypes
+
+def read_npz_results(file_path):
+    # scan.py --columnar output without pyarrow: answer and image codes are rebuilt as categoricals
+    with np.load(file_path) as data:
+        columns = [str(column) for column in data['columns']]
+        frame = {'ROLLNO': data['ROLLNO'].astype(object), 'QBNO': data['QBNO'].astype(object)}
+        codes = data['codes']
+        for i, column in enumerate(columns[2:-1]):
+            frame[column] = pd.Categorical.from_codes(codes[:, i], categories=data['labels'])
+        frame[columns[-1]] = pd.Categorical.from_codes(data['image_codes'], categories=data['images'])
+    return pd.DataFrame(frame, columns=columns)
+
+def parse_results(file_path):
+    if file_path.endswith('.xlsx'):
+        header = pd.read_excel(file_path, nrows=0).columns
+        df = pd.read_excel(file_path, dtype=result_dtypes(header))
+    elif file_path.endswith('.parquet'):
+        # scan.py --columnar: dictionary-encoded columns load as categoricals, with no text to parse
+        df = pd.read_parquet(file_path)
+    elif file_path.endswith('.npz'):
+        df = read_npz_results(file_path)
+    else:
+        header = pd.read_csv(file_path, nrows=0).columns
+        df = pd.read_csv(file_path, dtype=result_dtypes(header))
+    df.columns = df.columns.str.strip()
+    if 'ROLLNO' in df.columns:
+        df['ROLLNO'] = df['ROLLNO'].astype(str).str.strip()
+    return df
+
+def read_results(file_path, cache=False):
+    # Parses a SCANNED or IP file once for every check. With cache, the parsed frame is kept next
+    # to the file (Feather if pyarrow is installed, pickle otherwise) and reused until the file's
+    # modification time changes.
+    cache_path = file_path + CACHE_SUFFIX
+    mtime = os.stat(file_path).st_mtime_ns
+    if cache and os.path.exists(cache_path) and os.stat(cache_path).st_mtime_ns == mtime:
+        return pd.read_feather(cache_path) if cache_path.endswith('.feather') else pd.read_pickle(cache_path)
+    df = parse_results(file_path)
+    if cache:
+        if cache_path.endswith('.feather'):
+            df.to_feather(cache_path)
+        else:
+            df.to_pickle(cache_path)
+        # The cache carries the source file's mtime, which is all that is compared
+        os.utime(cache_path, ns=(mtime, mtime))
+    return df
+
 def upload_files():
+    # Dialog front end; tkinter is only imported here so the API and CLI run without a display
+    import tkinter as tk
+    import tkinter.messagebox as mb
+    from tkinter import simpledialog, filedialog
+
     root = tk.Tk()
     root.withdraw()  # Hide the main window
 
-    filetypes = [("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("All files", "*.*")]
+    filetypes = [("Excel files", "*.xlsx"), ("CSV files", "*.csv"), ("Columnar files", "*.parquet *.npz"),
+                 ("All files", "*.*")]
 
     file1_path = filedialog.askopenfilename(title="Select the first file (SCANNED DATA)", filetypes=filetypes)
     file2_path = filedialog.askopenfilename(title="Select the second file (IP DATA)", filetypes=filetypes)
     output_path = filedialog.asksaveasfilename(defaultextension=".xlsx", title="Save output Excel file")
     
-    last_column = simpledialog.askstring("Input", "Enter the last column to compare (e.g., A150):", parent=root)
+    last_column = simpledialog.askstring("Input", "Enter the last column to compare (e.g., A150), or leave it "
+                                         "blank for the last one in both files:", parent=root)
     
-    include_qpseries = simpledialog.askstring("Input", "Do you want to include the QPSERIES column in the comparison? (y/n):", parent=root).lower()
+    include_qpseries = (simpledialog.askstring("Input", "Do you want to include the QPSERIES column in the comparison? (y/n):", parent=root) or 'n').lower()
+
+    if file1_path and file2_path and output_path and last_column is not None:
+        try:
+            df1 = read_results(file1_path)
+            df2 = read_results(file2_path)
+        except Exception as e:
+            mb.showerror("Error", f"Error reading file: {e}", parent=root)
+            root.destroy()
+            return
 
-    if file1_path and file2_path and output_path and last_column:
-        if check_rollno_columns(file1_path, file2_path, root):
+        try:
+            warnings = validate_rollnos(df1, df2)
+        except Exception as e:
+            mb.showerror("Error", str(e), parent=root)
+            root.destroy()
             return
-        
-        duplicates_found = check_duplicates(file1_path, root) or check_duplicates(file2_path, root)
-        suffix_found = check_suffix_in_rollnos(file1_path, file2_path, root)
-        
-        if duplicates_found or suffix_found:
-            proceed = simpledialog.askstring("Proceed", "Duplicates or suffixes found in ROLLNO column. Do you want to proceed? (y/n):", parent=root).lower()
+
+        for title, message in warnings:
+            mb.showinfo(title, message, parent=root)
+        if warnings:
+            proceed = (simpledialog.askstring("Proceed", "Duplicates or suffixes found in ROLLNO column. Do you want to proceed? (y/n):", parent=root) or 'n').lower()
             if proceed == 'n':
                 root.destroy()
                 return
-        
-        check_discrepancy(file1_path, file2_path, output_path, last_column, include_qpseries, root)
+
+        try:
+            result = check_discrepancy(df1, df2, output_path, last_column, include_qpseries == 'y',
+                                       load_fills(file1_path))
+        except ValueError as e:
+            mb.showerror("Error", str(e), parent=root)
+            root.destroy()
+            return
+        if result['qpseries_compared']:
+            mb.showinfo("QPSERIES Included", "QPSERIES column was included in comparison. See 'QPSERIES Count' sheet for details.", parent=root)
         mb.showinfo("Success", "Data exported successfully to the chosen path!", parent=root)
     root.destroy()
 
-def check_rollno_columns(file1_path, file2_path, root):
-    try:
-        df1 = pd.read_excel(file1_path) if file1_path.endswith('.xlsx') else pd.read_csv(file1_path)
-        df2 = pd.read_excel(file2_path) if file2_path.endswith('.xlsx') else pd.read_csv(file2_path)
-        
-        if 'ROLLNO' not in df1.columns or 'ROLLNO' not in df2.columns:
-            mb.showerror("Error", "ROLLNO column missing in one or both files.", parent=root)
-            return True
-        
-        # Strip whitespace and convert to string for consistent comparison
-        df1['ROLLNO'] = df1['ROLLNO'].astype(str).str.strip()
-        df2['ROLLNO'] = df2['ROLLNO'].astype(str).str.strip()
-
-        # Use sets to check if the ROLLNO values are the same
-        set1 = set(df1['ROLLNO'])
-        set2 = set(df2['ROLLNO'])
-        
-        if set1 != set2:
-            mb.showerror("Error", "The 'ROLLNO' columns do not match between the two files.", parent=root)
-            return True
-    except Exception as e:
-        mb.showerror("Error", f"Error comparing ROLLNO columns: {e}", parent=root)
-        return True
-    return False
-
-def check_duplicates(file_path, root):
-    try:
-        df = pd.read_excel(file_path) if file_path.endswith('.xlsx') else pd.read_csv(file_path)
-        if 'ROLLNO' not in df.columns:
-            mb.showerror("Error", "ROLLNO column missing in the file.", parent=root)
-            return True
-        duplicates = df[df.duplicated('ROLLNO', keep=False)]
-        if not duplicates.empty:
-            duplicate_details = duplicates[['ROLLNO']].reset_index().to_string(index=False)
-            mb.showinfo("Duplicates Found", f"Duplicate ROLLNO values found:\n\n{duplicate_details}", parent=root)
-            return True
-    except Exception as e:
-        mb.showerror("Error", f"Error reading file: {e}", parent=root)
-        return True
-    return False
-
-def check_suffix_in_rollnos(file1_path, file2_path, root):
-    suffix_pattern = re.compile(r'[^\d]+')
-
-    try:
-        df1 = pd.read_excel(file1_path) if file1_path.endswith('.xlsx') else pd.read_csv(file1_path)
-        df2 = pd.read_excel(file2_path) if file2_path.endswith('.xlsx') else pd.read_csv(file2_path)
-        if 'ROLLNO' not in df1.columns or 'ROLLNO' not in df2.columns:
-            mb.showerror("Error", "ROLLNO column missing in one or both files.", parent=root)
-            return True
-        df1['ROLLNO'] = df1['ROLLNO'].astype(str)
-        df2['ROLLNO'] = df2['ROLLNO'].astype(str)
-        suffixes_file1 = [suffix_pattern.search(x).group() if suffix_pattern.search(x) else '' for x in df1['ROLLNO']]
-        suffixes_file2 = [suffix_pattern.search(x).group() if suffix_pattern.search(x) else '' for x in df2['ROLLNO']]
-        unique_suffixes_file1 = list(set(suffixes_file1))
-        unique_suffixes_file2 = list(set(suffixes_file2))
-        suffixes_file1_str = ', '.join(unique_suffixes_file1)
-        suffixes_file2_str = ', '.join(unique_suffixes_file2)
-        if unique_suffixes_file1 or unique_suffixes_file2:
-            mb.showinfo("Suffixes Found", f"Suffixes found in ROLLNO column:\n\nFile 1: {suffixes_file1_str}\nFile 2: {suffixes_file2_str}", parent=root)
-            return True
-    except Exception as e:
-        mb.showerror("Error", f"Error checking suffixes: {e}", parent=root)
-        return True
-    return False
-
-def check_discrepancy(file1_path, file2_path, output_path, last_column, include_qpseries, root):
-    df1 = pd.read_excel(file1_path) if file1_path.endswith('.xlsx') else pd.read_csv(file1_path)
-    df2 = pd.read_excel(file2_path) if file2_path.endswith('.xlsx') else pd.read_csv(file2_path)
-
-    df1.columns = df1.columns.str.strip()
-    df2.columns = df2.columns.str.strip()
-
-    df1['ROLLNO'] = df1['ROLLNO'].astype(str)
-    df2['ROLLNO'] = df2['ROLLNO'].astype(str)
-
-    df1.sort_values(by='ROLLNO', inplace=True)
-    df2.sort_values(by='ROLLNO', inplace=True)
-
+def rollno_key(rollnos):
+    # ROLLNOs as matched between the files: all-digit ones without their leading zeros, so a scanned
+    # '0123' pairs with an IP '123' whose zero Excel dropped, as when both were read as numbers.
+    # The ROLLNO as written is still what reports show.
+    rollnos = pd.Series(np.asarray(rollnos, dtype=object))
+    digits = rollnos.str.isdigit().fillna(False).to_numpy(dtype=bool)
+    keys = rollnos.to_numpy(dtype=object).copy()
+    stripped = rollnos[digits].str.lstrip('0')
+    keys[digits] = stripped.where(stripped != '', '0').to_numpy(dtype=object)
+    return keys
+
+def rollno_index(rollnos1, rollnos2):
+    # Every distinct ROLLNO of either file (by rollno_key, shown as first written) and how often it
+    # occurs in each, from one factorization of both columns
+    rollnos = np.concatenate([np.asarray(rollnos1, dtype=object), np.asarray(rollnos2, dtype=object)])
+    codes, uniques = pd.factorize(rollno_key(rollnos))
+    _, first = np.unique(codes, return_index=True)
+    counts1 = np.bincount(codes[:len(rollnos1)], minlength=len(uniques))
+    counts2 = np.bincount(codes[len(rollnos1):], minlength=len(uniques))
+    return rollnos[first], counts1, counts2
+
+def rollno_suffixes(rollnos):
+    # Distinct non-digit parts ('123A' -> 'A'); only values that are not all digits go through the regex
+    rollnos = pd.Series(rollnos, dtype=object)
+    return set(rollnos[~rollnos.str.isdigit()].str.extract(r'(\D+)', expand=False).dropna())
+
+def sample(values, limit=20):
+    values = sorted(values)
+    if not values:
+        return 'none'
+    text = ', '.join(values[:limit])
+    if len(values) > limit:
+        text += f' ... ({len(values)} in all)'
+    return text
+
+class RollnoCheck:
+    # ROLLNO checks for a SCANNED/IP pair: ROLLNOs found in only one file, repeated ROLLNOs and
+    # non-digit suffixes. Whole files, or partitions that split both files by ROLLNO alike, can be
+    # added; the full lists stay on the object and the messages show the first few.
+    def __init__(self):
+        self.missing = []  # only in file 1
+        self.extra = []  # only in file 2
+        self.duplicates = ({}, {})
+        self.suffixes = (set(), set())
+
+    def add(self, rollnos1, rollnos2):
+        rollnos, counts1, counts2 = rollno_index(rollnos1, rollnos2)
+        self.missing.extend(rollnos[(counts1 > 0) & (counts2 == 0)])
+        self.extra.extend(rollnos[(counts2 > 0) & (counts1 == 0)])
+        for duplicates, suffixes, counts in zip(self.duplicates, self.suffixes, (counts1, counts2)):
+            repeated = counts > 1
+            duplicates.update(zip(rollnos[repeated], counts[repeated]))
+            suffixes.update(rollno_suffixes(rollnos[counts > 0]))
+
+    def check(self):
+        if self.missing or self.extra:
+            raise ValueError("The 'ROLLNO' columns do not match between the two files.\n\n"
+                             f"Only in file 1: {sample(self.missing)}\nOnly in file 2: {sample(self.extra)}")
+
+    def warnings(self):
+        # (title, message) pairs the user may choose to proceed past
+        warnings = []
+        if any(self.duplicates):
+            details = [f"File {number}: {sample(f'{rollno} (x{count})' for rollno, count in duplicates.items())}"
+                       for number, duplicates in enumerate(self.duplicates, start=1)]
+            warnings.append(("Duplicates Found", "Duplicate ROLLNO values found:\n\n" + '\n'.join(details)))
+        if any(self.suffixes):
+            warnings.append(("Suffixes Found", "Suffixes found in ROLLNO column:\n\n"
+                             f"File 1: {', '.join(sorted(self.suffixes[0]))}\nFile 2: {', '.join(sorted(self.suffixes[1]))}"))
+        return warnings
+
+def validate_rollnos(df1, df2):
+    # Raises ValueError when the files cannot be compared at all; returns the warnings otherwise
+    if 'ROLLNO' not in df1.columns or 'ROLLNO' not in df2.columns:
+        raise ValueError("ROLLNO column missing in one or both files.")
+    check = RollnoCheck()
+    check.add(df1['ROLLNO'], df2['ROLLNO'])
+    check.check()
+    return check.warnings()
+
+def pair_rows(df1, df2):
+    # Row positions of df1 and df2 paired on rollno_key, in df1's ROLLNO order as written. A ROLLNO
+    # repeated in both files is paired in file order (first with first, second with second);
+    # unpaired rows are left out.
+    left = pd.DataFrame({'ROLLNO': rollno_key(df1['ROLLNO']), 'row1': np.arange(len(df1)),
+                         'written': df1['ROLLNO'].to_numpy(dtype=object)})
+    left['occurrence'] = left.groupby('ROLLNO').cumcount()
+    right = pd.DataFrame({'ROLLNO': rollno_key(df2['ROLLNO']), 'row2': np.arange(len(df2))})
+    right['occurrence'] = right.groupby('ROLLNO').cumcount()
+    pairs = left.merge(right, on=['ROLLNO', 'occurrence']).sort_values(['written', 'occurrence'], kind='stable')
+    return pairs['row1'].to_numpy(), pairs['row2'].to_numpy()
+
+def compare_frames(df1, df2, columns):
+    # One row per differing cell, in ROLLNO then column order. Cells are compared as Python objects,
+    # like row1[col] != row2[col], so an empty cell never matches (NaN != NaN).
+    rows1, rows2 = pair_rows(df1, df2)
+    scanned = df1[columns].to_numpy(dtype=object)[rows1]
+    extracted = df2[columns].to_numpy(dtype=object)[rows2]
+    rows, cols = np.nonzero(scanned != extracted)
+    return pd.DataFrame({
+        'ROLLNO': df1['ROLLNO'].to_numpy(dtype=object)[rows1][rows],
+        'COLUMN': np.array(columns, dtype=object)[cols],
+        'Scanned': scanned[rows, cols],
+        'Extracted': extracted[rows, cols],
+        'Image Path': df1['Front side Image'].to_numpy(dtype=object)[rows1][rows]
+    })
+
+def load_fills(file1_path, fills_file=None):
+    # The scan.py --fills sidecar of a SCANNED file: <name>.fills.npz next to it, or fills_file.
+    # Returns None when there is none to use.
+    if fills_file is None:
+        fills_file = os.path.splitext(file1_path)[0] + '.fills.npz'
+        if not os.path.exists(fills_file):
+            return None
+        # scan.py writes the sidecar after its CSV and columnar copy, so an older one is left over
+        if os.path.getmtime(fills_file) < os.path.getmtime(file1_path):
+            print(f"Warning: ignoring {fills_file}, which is older than {file1_path}")
+            return None
+    elif not os.path.exists(fills_file):
+        raise ValueError(f"Fill ratio file not found: {fills_file}")
+    with np.load(fills_file) as data:
+        fills = {key: data[key] for key in ('image', 'question_confidence', 'confidence')}
+        # Sidecars written before QPSERIES had its own confidence leave its mismatches to REVIEW
+        fills['qpseries_confidence'] = data['qpseries_confidence'] if 'qpseries_confidence' in data \
+            else np.zeros(len(fills['image']), dtype=np.float32)
+    return fills
+
+def review_status(mismatches, fills, min_confidence=0.5):
+    # Adds the scan confidence of each differing cell and whether it needs a look at the sheet.
+    # A question or QPSERIES uses the confidence of its own bubbles, any other column the sheet confidence.
+    # Cells whose image is not in the sidecar are always queued for REVIEW.
+    rows = pd.Index(fills['image']).get_indexer(mismatches['Image Path'].astype(str))
+    known = rows >= 0
+    question = pd.to_numeric(mismatches['COLUMN'].str[1:], errors='coerce').to_numpy()
+    question = np.where(mismatches['COLUMN'].str.startswith('A').to_numpy() & known, question, 0)
+    has_question = (question >= 1) & (question <= fills['question_confidence'].shape[1])
+    confidence = fills['confidence'][np.where(known, rows, 0)].astype(float)
+    per_question = fills['question_confidence'][np.where(known, rows, 0), np.where(has_question, question - 1, 0).astype(int)]
+    confidence = np.where(has_question, per_question, confidence)
+    is_qpseries = (mismatches['COLUMN'] == 'QPSERIES').to_numpy()
+    confidence = np.where(is_qpseries, fills['qpseries_confidence'][np.where(known, rows, 0)], confidence).round(2)
+    mismatches = mismatches.copy()
+    mismatches['Confidence'] = pd.Series(confidence, index=mismatches.index, dtype=object).where(known, None)
+    mismatches['Status'] = np.where(known & (confidence >= min_confidence), 'AUTO', 'REVIEW')
+    return mismatches
+
+class ReportWriter:
+    # Streams the discrepancy workbook with openpyxl's write-only mode, so rows go to disk as they
+    # are added and memory stays flat however many discrepancies there are. The style objects are
+    # created once and shared by every cell. Layout: 'Discrepancies' rows, the total a row below,
+    # then the per-ROLLNO counts; QPSERIES mismatches go to the 'QPSERIES Count' sheet. With review,
+    # rows also carry the Confidence and Status columns of review_status.
+    headers = ['ROLLNO', 'COLUMN', 'Scanned', 'Extracted', 'Image Path']
+    review_headers = ['Confidence', 'Status']
+
+    def __init__(self, output_path, review=False):
+        self.output_path = output_path
+        self.headers = self.headers + self.review_headers if review else self.headers
+        self.workbook = Workbook(write_only=True)
+        self.discrepancy_sheet = self.workbook.create_sheet(title='Discrepancies')
+        self.qpseries_sheet = self.workbook.create_sheet(title='QPSERIES Count')
+        thin = Side(style='thin')
+        self.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        self.header_font = Font(bold=True)
+        self.total_font = Font(bold=True, color="FF0000")  # Red color for visibility
+        self.total_fill = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid')  # Yellow background
+        self.rollno_counts = Counter()
+        self.total = 0
+        self.qpseries_total = 0
+        self.review_total = 0 if review else None
+        for worksheet in (self.discrepancy_sheet, self.qpseries_sheet):
+            worksheet.append(self.cells(worksheet, self.headers, font=self.header_font, border=self.border))
+
+    def cells(self, worksheet, values, font=None, border=None, fill=None):
+        row = []
+        for value in values:
+            cell = WriteOnlyCell(worksheet, value=value)
+            if font is not None:
+                cell.font = font
+            if border is not None:
+                cell.border = border
+            if fill is not None:
+                cell.fill = fill
+            row.append(cell)
+        return row
+
+    def add(self, mismatches):
+        # mismatches: rows of (ROLLNO, COLUMN, Scanned, Extracted, Image Path), e.g. from compare_frames
+        if 'Status' in mismatches:
+            self.review_total += int((mismatches['Status'] == 'REVIEW').sum())
+        for values in mismatches.itertuples(index=False, name=None):
+            if values[1] == 'QPSERIES':
+                self.qpseries_sheet.append(self.cells(self.qpseries_sheet, values, border=self.border))
+                self.qpseries_total += 1
+            else:
+                # The header, the rows, the total between blank rows and one count per ROLLNO must all fit
+                rollnos = len(self.rollno_counts) + (values[0] not in self.rollno_counts)
+                if self.total + 1 + rollnos + 4 > EXCEL_MAX_ROWS:
+                    raise ValueError("Too many discrepancies for an Excel sheet; write the report to a .csv file instead.")
+                self.discrepancy_sheet.append(self.cells(self.discrepancy_sheet, values, border=self.border))
+                self.rollno_counts[values[0]] += 1
+                self.total += 1
+
+    def close(self):
+        worksheet = self.discrepancy_sheet
+        # Write total discrepancies count clearly, a row below the discrepancies
+        worksheet.append([])
+        worksheet.append(self.cells(worksheet, [f"Total Discrepancies: {self.total}"], font=self.total_font,
+                                    fill=self.total_fill))
+        worksheet.append([])
+        # Most discrepancies first; ROLLNOs with equal counts keep their order of appearance
+        for rollno, count in sorted(self.rollno_counts.items(), key=lambda item: -item[1]):
+            worksheet.append([rollno, count])
+        self.workbook.save(self.output_path)
+
+class CsvReportWriter:
+    # ReportWriter for reports too big for an Excel sheet (or wanted as text). The discrepancy rows
+    # go to output_path, QPSERIES mismatches to <name>_qpseries.csv and the per-ROLLNO counts to
+    # <name>_counts.csv, each written as rows are added.
+    def __init__(self, output_path, review=False):
+        stem = os.path.splitext(output_path)[0]
+        self.counts_path = stem + '_counts.csv'
+        self.discrepancy_file = open(output_path, 'w', newline='')
+        self.qpseries_file = open(stem + '_qpseries.csv', 'w', newline='')
+        for f in (self.discrepancy_file, self.qpseries_file):
+            csv.writer(f).writerow(ReportWriter.headers + ReportWriter.review_headers if review else ReportWriter.headers)
+        self.rollno_counts = Counter()
+        self.total = 0
+        self.qpseries_total = 0
+        self.review_total = 0 if review else None
+
+    def add(self, mismatches):
+        if 'Status' in mismatches:
+            self.review_total += int((mismatches['Status'] == 'REVIEW').sum())
+        is_qpseries = (mismatches['COLUMN'] == 'QPSERIES').to_numpy()
+        mismatches[is_qpseries].to_csv(self.qpseries_file, header=False, index=False)
+        discrepancies = mismatches[~is_qpseries]
+        discrepancies.to_csv(self.discrepancy_file, header=False, index=False)
+        # Counter.update adds; new ROLLNOs keep their order of appearance
+        self.rollno_counts.update(discrepancies['ROLLNO'].value_counts(sort=False).to_dict())
+        self.total += len(discrepancies)
+        self.qpseries_total += int(is_qpseries.sum())
+
+    def close(self):
+        self.discrepancy_file.close()
+        self.qpseries_file.close()
+        with open(self.counts_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ROLLNO', 'Count_in_Discrepancies'])
+            writer.writerows(sorted(self.rollno_counts.items(), key=lambda item: -item[1]))
+
+def report_writer(output_path, review=False):
+    writer_class = CsvReportWriter if output_path.lower().endswith('.csv') else ReportWriter
+    return writer_class(output_path, review)
+
+def answer_numbers(columns):
+    return {int(name[1:]) for name in columns if ANSWER_COLUMN.match(name)}
+
+def comparison_columns(columns1, columns2, last_column, include_qpseries):
+    # ROLLNO plus the columns to compare, up to last_column or, without it, the last answer column
+    # of both files; raises ValueError for bad input
+    if not last_column:
+        common = answer_numbers(columns1) & answer_numbers(columns2)
+        if not common:
+            raise ValueError("No answer columns (A1, A2, ...) found in both files.")
+        last_column = f'A{max(common)}'
     try:
         last_column_index = int(last_column[1:])
         if last_column_index < 1 or last_column_index > 150:
             raise ValueError
-        columns_to_compare = ['ROLLNO'] + [f'A{i}' for i in range(1, last_column_index + 1)]
-        if include_qpseries == 'y' and 'QPSERIES' in df1.columns and 'QPSERIES' in df2.columns:
-            columns_to_compare.insert(1, 'QPSERIES')
     except ValueError:
-        mb.showerror("Error", "Invalid column input. Please enter a valid column like A5 or A150.", parent=root)
-        return
-
-    if 'Front side Image' not in df1.columns:
-        mb.showerror("Error", "'Front Side Image' column not found in the first file.", parent=root)
-        print("Available columns in file 1:", df1.columns)
-        return
-
+        raise ValueError("Invalid column input. Please enter a valid column like A5 or A150.")
+    columns_to_compare = ['ROLLNO'] + [f'A{i}' for i in range(1, last_column_index + 1)]
+    for label, columns in (('first', columns1), ('second', columns2)):
+        missing = [name for name in columns_to_compare if name not in columns]
+        if missing:
+            shown = ', '.join(missing[:5]) + (f" and {len(missing) - 5} more" if len(missing) > 5 else '')
+            raise ValueError(f"Column(s) {shown} not found in the {label} file; "
+                             f"its last answer column is A{max(answer_numbers(columns), default=0)}.")
+    if include_qpseries and 'QPSERIES' in columns1 and 'QPSERIES' in columns2:
+        columns_to_compare.insert(1, 'QPSERIES')
+
+    if 'Front side Image' not in columns1:
+        raise ValueError(f"'Front Side Image' column not found in the first file. Available columns: {', '.join(columns1)}")
+    return columns_to_compare
+
+def check_discrepancy(df1, df2, output_path, last_column, include_qpseries=False, fills=None, min_confidence=0.5):
+    # Writes the discrepancy report (.xlsx, or .csv files) and returns its counts. With the fills
+    # of load_fills, each discrepancy is marked AUTO or REVIEW by its scan confidence.
+    columns_to_compare = comparison_columns(df1.columns, df2.columns, last_column, include_qpseries)
     df1 = df1[columns_to_compare + ['Front side Image']]
     df2 = df2[columns_to_compare]
 
-    discrepancies = []
-    qpseries_rows = []
-
-    for idx in range(len(df1)):
-        row1 = df1.iloc[idx]
-        row2 = df2.iloc[idx]
-        rollno = row1['ROLLNO']
-        image_path = row1.get('Front side Image', '')
-
-        for col in columns_to_compare[1:]:
-            if row1[col] != row2[col]:
-                if col == 'QPSERIES':
-                    qpseries_rows.append({
-                        'ROLLNO': rollno,
-                        'COLUMN': col,
-                        'Scanned': row1[col],
-                        'Extracted': row2[col],
-                        'Image Path': image_path
-                    })
-                else:
-                    discrepancies.append({
-                        'ROLLNO': rollno,
-                        'COLUMN': col,
-                        'Scanned': row1[col],
-                        'Extracted': row2[col],
-                        'Image Path': image_path
-                    })
-
-    discrepancy_df = pd.DataFrame(discrepancies)
-    qpseries_df = pd.DataFrame(qpseries_rows)
-
-    rollno_counts = discrepancy_df['ROLLNO'].value_counts().reset_index()
-    rollno_counts.columns = ['ROLLNO', 'Count_in_Discrepancies']
-
-    total_discrepancies = len(discrepancies)
-
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = 'Discrepancies'
-
-    headers = ['ROLLNO', 'COLUMN', 'Scanned', 'Extracted', 'Image Path']
-    for col_num, header in enumerate(headers, start=1):
-        cell = worksheet.cell(row=1, column=col_num, value=header)
-        cell.font = Font(bold=True)
-        cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-
-    for row_num, discrepancy in enumerate(discrepancies, start=2):
-        for col_num, header in enumerate(headers, start=1):
-            cell = worksheet.cell(row=row_num, column=col_num, value=discrepancy.get(header, ''))
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-
-    # Write total discrepancies count clearly
-    total_discrepancies_label = f"Total Discrepancies: {total_discrepancies}"
-    total_discrepancies_cell = f'A{len(discrepancies) + 3}'  # Place it a few rows below the discrepancies
-    total_discrepancies_cell_obj = worksheet[total_discrepancies_cell]
-    total_discrepancies_cell_obj.value = total_discrepancies_label
-    total_discrepancies_cell_obj.font = Font(bold=True, color="FF0000")  # Red color for visibility
-    total_discrepancies_cell_obj.fill = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid')  # Yellow background
-
-    for row_num, (rollno, count) in enumerate(rollno_counts.values, start=len(discrepancies) + 5):
-        worksheet[f'A{row_num}'] = rollno
-        worksheet[f'B{row_num}'] = count
-
-    qpseries_sheet = workbook.create_sheet(title='QPSERIES Count')
-    qpseries_headers = ['ROLLNO', 'COLUMN', 'Scanned', 'Extracted', 'Image Path']
-    for col_num, header in enumerate(qpseries_headers, start=1):
-        cell = qpseries_sheet.cell(row=1, column=col_num, value=header)
-        cell.font = Font(bold=True)
-        cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-
-    for row_num, qpseries_row in enumerate(qpseries_rows, start=2):
-        for col_num, value in enumerate(qpseries_row.values(), start=1):
-            cell = qpseries_sheet.cell(row=row_num, column=col_num, value=value)
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-
-    workbook.save(output_path)
-
-    if include_qpseries == 'y' and 'QPSERIES' in columns_to_compare:
-        mb.showinfo("QPSERIES Included", "QPSERIES column was included in comparison. See 'QPSERIES Count' sheet for details.", parent=root)
+    mismatches = compare_frames(df1, df2, columns_to_compare[1:])
+    report = report_writer(output_path, fills is not None)
+    if fills is not None:
+        mismatches = review_status(mismatches, fills, min_confidence)
+    report.add(mismatches)
+    report.close()
+    return {'discrepancies': report.total, 'qpseries': report.qpseries_total,
+            'qpseries_compared': 'QPSERIES' in columns_to_compare, 'review': report.review_total}
+
+def rows_per_chunk(file_path, memory_bytes):
+    # Rows of file_path that fit the memory budget, from the average line length of its first MB.
+    # Reading, hashing and splitting a chunk takes about twice the memory of comparing it.
+    with open(file_path, 'rb') as f:
+        sample = f.read(1 << 20)
+    bytes_per_row = max(1, len(sample) // max(1, sample.count(b'\n')))
+    return max(1000, memory_bytes // (2 * MEMORY_PER_BYTE * bytes_per_row))
+
+def csv_header(file_path):
+    return list(pd.read_csv(file_path, nrows=0).columns.str.strip())
+
+def partition_file(file_path, header, parts, chunk_rows, tmp_dir, name):
+    # Streams a CSV in chunks into `parts` CSV files by a hash of rollno_key, so every row of a ROLLNO
+    # lands in the same partition, in file order. Values are copied as text.
+    paths = [os.path.join(tmp_dir, f'{name}{part}.csv') for part in range(parts)]
+    for path in paths:
+        pd.DataFrame(columns=header).to_csv(path, index=False)
+    for chunk in pd.read_csv(file_path, dtype=str, chunksize=chunk_rows):
+        chunk.columns = header
+        chunk['ROLLNO'] = chunk['ROLLNO'].astype(str).str.strip()
+        part_of_row = pd.util.hash_pandas_object(pd.Series(rollno_key(chunk['ROLLNO'])), index=False).to_numpy() % parts
+        for part, rows in chunk.groupby(part_of_row, sort=False):
+            rows.to_csv(paths[part], mode='a', header=False, index=False)
+    return paths
+
+def compare_chunked(file1_path, file2_path, output_path, last_column=None, include_qpseries=False, strict=False,
+                    memory_mb=512, fills=None, min_confidence=0.5):
+    # Out-of-core compare_files for CSV inputs too large to load whole. Both files are streamed into
+    # ROLLNO hash partitions sized to memory_mb, next to the output. Each partition pair is checked,
+    # compared and appended to the report. Rows come out in ROLLNO order within each partition;
+    # use a .csv output past Excel's row limit.
+    for file_path in (file1_path, file2_path):
+        if not file_path.lower().endswith('.csv'):
+            raise ValueError(f"Chunked comparison needs CSV input: {file_path}")
+    # Bad input fails before anything is partitioned
+    header1, header2 = csv_header(file1_path), csv_header(file2_path)
+    if 'ROLLNO' not in header1 or 'ROLLNO' not in header2:
+        raise ValueError("ROLLNO column missing in one or both files.")
+    columns_to_compare = comparison_columns(header1, header2, last_column, include_qpseries)
+    memory_bytes = memory_mb * 1024 * 1024
+    input_bytes = os.path.getsize(file1_path) + os.path.getsize(file2_path)
+    parts = max(1, math.ceil(input_bytes * MEMORY_PER_BYTE / memory_bytes))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        paths1 = partition_file(file1_path, header1, parts, rows_per_chunk(file1_path, memory_bytes), tmp_dir, 'scanned')
+        paths2 = partition_file(file2_path, header2, parts, rows_per_chunk(file2_path, memory_bytes), tmp_dir, 'ip')
+
+        # A ROLLNO is always in the same partition of both files, so checking partition pairs
+        # checks the whole files
+        check = RollnoCheck()
+        for path1, path2 in zip(paths1, paths2):
+            check.add(pd.read_csv(path1, usecols=['ROLLNO'], dtype=str, keep_default_na=False)['ROLLNO'],
+                      pd.read_csv(path2, usecols=['ROLLNO'], dtype=str, keep_default_na=False)['ROLLNO'])
+        check.check()
+        warnings = check.warnings()
+        if warnings and strict:
+            raise ValueError('; '.join(title for title, message in warnings))
+
+        report = report_writer(output_path, fills is not None)
+        for path1, path2 in zip(paths1, paths2):
+            df1 = parse_results(path1)[columns_to_compare + ['Front side Image']]
+            df2 = parse_results(path2)[columns_to_compare]
+            mismatches = compare_frames(df1, df2, columns_to_compare[1:])
+            if fills is not None:
+                mismatches = review_status(mismatches, fills, min_confidence)
+            report.add(mismatches)
+        report.close()
+    return {'discrepancies': report.total, 'qpseries': report.qpseries_total,
+            'qpseries_compared': 'QPSERIES' in columns_to_compare, 'review': report.review_total,
+            'warnings': warnings}
+
+def compare_files(file1_path, file2_path, output_path, last_column=None, include_qpseries=False, strict=False,
+                  cache=False, memory_mb=None, fills_file=None, min_confidence=0.5):
+    # Headless version of the GUI: SCANNED file, IP file, output report. Duplicate or suffixed
+    # ROLLNOs are returned as warnings, or raise ValueError with strict. With memory_mb, CSV inputs
+    # are compared out of core within roughly that much memory. When the SCANNED file has a
+    # scan.py --fills sidecar (or fills_file), discrepancies are marked AUTO or REVIEW.
+    fills = load_fills(file1_path, fills_file)
+    if memory_mb:
+        return compare_chunked(file1_path, file2_path, output_path, last_column, include_qpseries, strict, memory_mb,
+                               fills, min_confidence)
+    df1 = read_results(file1_path, cache)
+    df2 = read_results(file2_path, cache)
+    warnings = validate_rollnos(df1, df2)
+    if warnings and strict:
+        raise ValueError('; '.join(title for title, message in warnings))
+    result = check_discrepancy(df1, df2, output_path, last_column, include_qpseries, fills, min_confidence)
+    result['warnings'] = warnings
+    return result
+
+def default_output(file1_path, output_dir=None):
+    stem = os.path.splitext(os.path.basename(file1_path))[0]
+    return os.path.join(output_dir or os.path.dirname(os.path.abspath(file1_path)), f'{stem}_discrepancies.xlsx')
+
+def _compare_pair(task):
+    file1_path, file2_path, output_path, options = task
+    try:
+        return task[:3], compare_files(file1_path, file2_path, output_path, **options), None
+    except Exception as e:
+        return task[:3], None, str(e)
+
+def compare_pairs(pairs, workers=1, **options):
+    # Yields ((scanned, ip, output), result, error) for each triple in pairs, in order. Pairs are
+    # independent, so with workers > 1 each one is compared in its own process.
+    tasks = [(file1_path, file2_path, output_path, options) for file1_path, file2_path, output_path in pairs]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            yield from pool.imap(_compare_pair, tasks)
     else:
-        mb.showinfo("Success", "Data exported successfully to the chosen path!", parent=root)
+        for task in tasks:
+            yield _compare_pair(task)
 
 if __name__ == "__main__":
-    upload_files()
+    parser = argparse.ArgumentParser(description='Compare SCANNED and IP result files and export the discrepancies to Excel. '
+                                                 'Run without files to use the dialogs.')
+    parser.add_argument('files', nargs='*', metavar='SCANNED IP', help='one or more SCANNED/IP file pairs')
+    parser.add_argument('--last-column',
+                        help='last answer column to compare (default: the last A<n> column in both files)')
+    parser.add_argument('--qpseries', action='store_true', help='also compare QPSERIES (see the QPSERIES Count sheet)')
+    parser.add_argument('--output', help='output report for a single pair, .xlsx or .csv (default: <SCANNED>_discrepancies.xlsx)')
+    parser.add_argument('--output-dir', help='write the workbooks here instead of next to each SCANNED file')
+    parser.add_argument('--workers', type=int, default=1, help='pairs compared in parallel (default: 1)')
+    parser.add_argument('--strict', action='store_true', help='skip pairs with duplicated or suffixed ROLLNOs')
+    parser.add_argument('--cache', action='store_true', help='reuse parsed input files while they are unchanged')
+    parser.add_argument('--memory-mb', type=int,
+                        help='compare CSV inputs in chunks within about this much memory per pair')
+    parser.add_argument('--fills', metavar='FILE',
+                        help='scan.py --fills sidecar for a single pair (default: <SCANNED>.fills.npz when present)')
+    parser.add_argument('--min-confidence', type=float, default=0.5,
+                        help='scan confidence below which a discrepancy is marked REVIEW (default: 0.5)')
+    args = parser.parse_args()
+    if not args.files:
+        upload_files()
+        sys.exit(0)
+    if len(args.files) % 2:
+        parser.error('files must come in SCANNED IP pairs')
+    if args.output and len(args.files) > 2:
+        parser.error('--output needs a single pair; use --output-dir')
+    if args.fills and len(args.files) > 2:
+        parser.error('--fills needs a single pair')
+
+    pairs = []
+    for file1_path, file2_path in zip(args.files[::2], args.files[1::2]):
+        pairs.append((file1_path, file2_path, args.output or default_output(file1_path, args.output_dir)))
+    failed = 0
+    for (file1_path, file2_path, output_path), result, error in compare_pairs(
+            pairs, args.workers, last_column=args.last_column, include_qpseries=args.qpseries, strict=args.strict,
+            cache=args.cache, memory_mb=args.memory_mb, fills_file=args.fills, min_confidence=args.min_confidence):
+        if error:
+            failed += 1
+            print(f"Error: {file1_path} vs {file2_path}: {error}")
+            continue
+        for title, message in result['warnings']:
+            print(f"Warning: {file1_path} vs {file2_path}: {title}")
+            for line in message.splitlines()[2:]:
+                print(f"    {line}")
+        review = f", {result['review']} to review" if result['review'] is not None else ''
+        print(f"{file1_path} vs {file2_path}: {result['discrepancies']} discrepancies, "
+              f"{result['qpseries']} QPSERIES mismatches{review} -> {output_path}")
+    if failed:
+        sys.exit(1)
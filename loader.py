@@ -0,0 +1,38 @@
+import cv2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch_images(image_paths, depth=8, max_megabytes=512, flags=cv2.IMREAD_GRAYSCALE):
+    # Yields (image_path, image) in input order while the next images are read and decoded on
+    # background threads (cv2.imread releases the GIL). At most `depth` images are in flight, and
+    # fewer when that many decoded images would exceed max_megabytes. image is None if unreadable.
+    if depth <= 0:
+        for image_path in image_paths:
+            yield image_path, cv2.imread(image_path, flags)
+        return
+
+    max_bytes = max_megabytes * 1024 * 1024
+    image_paths = iter(image_paths)
+    pending = deque()
+    image_bytes = 0
+    executor = ThreadPoolExecutor(min(depth, 4))
+    try:
+        while True:
+            # Size the window from the largest image seen so far; always keep at least one in flight
+            while len(pending) < depth and (not pending or (len(pending) + 1) * image_bytes <= max_bytes):
+                image_path = next(image_paths, None)
+                if image_path is None:
+                    break
+                pending.append((image_path, executor.submit(cv2.imread, image_path, flags)))
+            if not pending:
+                break
+            image_path, future = pending.popleft()
+            image = future.result()
+            if image is not None:
+                image_bytes = max(image_bytes, image.nbytes)
+            yield image_path, image
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,91 @@
+import json
+import os
+
+MANIFEST_FILE = 'omr_manifest.jsonl'
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ImageManifest:
+    # Append-only JSON-lines log of per-image alignment and scan results, kept next to the images.
+    # Each line updates one image; when the log is read back the latest value of every field wins,
+    # so a run that dies half-way still leaves everything it finished on record.
+    def __init__(self, image_dir, filename=MANIFEST_FILE):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, filename)
+        self.entries = {}
+        self.existed = os.path.exists(self.path)
+        self.file = None
+        self.load()
+
+    def key(self, image_path):
+        return os.path.relpath(image_path, self.image_dir).replace(os.sep, '/')
+
+    def load(self):
+        if not self.existed:
+            return
+        line_count = 0
+        line = '\n'
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line_count += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line from an interrupted run
+                    continue
+                self.entries.setdefault(record['image'], {}).update(record)
+        # A torn last line has no newline, and the next record() would be appended to it and lost
+        # on the next load, so the log is rewritten without it first
+        if not line.endswith('\n') or line_count > 2 * len(self.entries) + 100:
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def get(self, image_path):
+        return self.entries.get(self.key(image_path), {})
+
+    def record(self, image_path, **fields):
+        key = self.key(image_path)
+        entry = self.entries.setdefault(key, {'image': key})
+        entry.update(fields)
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(dict(fields, image=key)) + '\n')
+        self.file.flush()
+
+    def is_aligned(self, image_path):
+        return self.get(image_path).get('aligned') == file_signature(image_path)
+
+    def is_rejected(self, image_path):
+        # Rejected at alignment and unchanged since
+        entry = self.get(image_path)
+        return entry.get('align_status') == 'rejected' and entry.get('rejected') == file_signature(image_path)
+
+    def is_scanned(self, image_path, template, signature=None):
+        # Scanned with this template fingerprint, and the file unchanged since
+        entry = self.get(image_path)
+        if signature is None:
+            signature = file_signature(image_path)
+        return entry.get('scanned') == signature and entry.get('template') == template
+
+    def scanned_row(self, image_path, template):
+        # The decoded row (without the image path) if the file and template are unchanged since it was scanned
+        if self.is_scanned(image_path, template):
+            return self.get(image_path).get('row')
+        return None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,147 @@
+import os
+import sys
+import shutil
+import argparse
+from manifest import ImageManifest
+from align import ALIGNMENT_MARKER, adopt_marker, find_image_files, add_aligner_arguments, aligner_from_args
+from scan import OMRScanner, decode_images, sidecar_paths, remove_files
+
+SCAN_MARKER = 'scan_done.txt'
+
+
+def find_folders(base_dir):
+    # Subfolders of base_dir that hold F.jpg sheets, like the old Jenkins loop. A base_dir whose
+    # sheets are not in subfolders is processed as a single folder.
+    folders = []
+    for name in sorted(os.listdir(base_dir)):
+        folder = os.path.join(base_dir, name)
+        if os.path.isdir(folder) and find_image_files(folder):
+            folders.append(folder)
+    if not folders and find_image_files(base_dir):
+        folders.append(base_dir)
+    return folders
+
+
+def folder_name(folder):
+    return os.path.basename(os.path.normpath(folder))
+
+
+def write_marker(folder, marker, text):
+    with open(os.path.join(folder, marker), 'w') as f:
+        f.write(text)
+
+
+class FolderPipeline:
+    # Aligns and scans every sheet folder under base_dir in one process. The pending sheets of all
+    # folders go through a single decode stream, so one worker pool is started for the whole run
+    # and stays busy across folder boundaries. Each folder keeps its own manifest, marker files
+    # and <folder>.csv.
+    def __init__(self, base_dir, template_file, aligner=None, workers=1, force=False, write_aligned=True, warp=True,
+                 prefetch=8, prefetch_mb=512, collect_dir=None, fills=False, columnar=False):
+        self.base_dir = base_dir
+        self.template_file = template_file
+        self.aligner = aligner
+        self.workers = workers
+        self.force = force
+        self.write_aligned = write_aligned
+        self.warp = warp
+        self.prefetch = prefetch
+        self.prefetch_mb = prefetch_mb
+        self.collect_dir = collect_dir
+        self.fills = fills
+        self.columnar = columnar
+
+    def scanner_for(self, folder):
+        if self.aligner is not None and not self.force:
+            manifest = ImageManifest(folder)
+            adopt_marker(manifest, find_image_files(folder), os.path.join(folder, ALIGNMENT_MARKER))
+            manifest.close()
+        output_csv = os.path.join(folder, f'{folder_name(folder)}.csv')
+        # --force realigns and rescans everything, including sheets in the reject queue
+        return OMRScanner(self.template_file, folder, output_csv, workers=self.workers, rescan=self.force,
+                          prefetch=self.prefetch, prefetch_mb=self.prefetch_mb, aligner=self.aligner,
+                          write_aligned=self.write_aligned, warp=self.warp, include_rejected=self.force,
+                          realign=self.force, fills=self.fills, columnar=self.columnar)
+
+    def run(self):
+        folders = find_folders(self.base_dir)
+        if not folders:
+            raise ValueError(f"No subfolders with F.jpg files found under {self.base_dir}")
+        print(f"Found {len(folders)} folders to process: {', '.join(folder_name(folder) for folder in folders)}")
+
+        scanners = []
+        tasks = []
+        for folder in folders:
+            print(f"Preparing {folder_name(folder)}")
+            scanner = self.scanner_for(folder)
+            folder_tasks = scanner.prepare()
+            if folder_tasks is None:
+                continue
+            scanners.append(scanner)
+            tasks.extend(folder_tasks)
+        print(f"{len(tasks)} images to process across {len(scanners)} folders with {max(1, self.workers)} worker(s)")
+
+        # Every folder shares the template, so one layout (and atlas) decodes all of them
+        first = scanners[0]
+        results = decode_images(tasks, first.layout, self.aligner, self.write_aligned, first.atlas, self.workers,
+                                self.prefetch, self.prefetch_mb)
+        row_counts = []
+        try:
+            for scanner in scanners:
+                name = folder_name(scanner.image_dir)
+                print("========================================")
+                print(f"Processing subfolder: {name}")
+                print("========================================")
+                row_counts.append((name, scanner.write_results(results)))
+                if self.aligner is not None and self.write_aligned:
+                    write_marker(scanner.image_dir, ALIGNMENT_MARKER, 'Alignment complete.')
+                write_marker(scanner.image_dir, SCAN_MARKER, 'Scan complete.')
+                if self.collect_dir and os.path.exists(scanner.output_csv):
+                    shutil.copy(scanner.output_csv, self.collect_dir)
+                    print(f"Copied {os.path.basename(scanner.output_csv)} to {self.collect_dir}")
+                    # The scan removed any sidecar it did not rewrite; so do the collected copies
+                    for path in sidecar_paths(scanner.output_csv):
+                        if os.path.exists(path):
+                            shutil.copy(path, self.collect_dir)
+                        else:
+                            remove_files([os.path.join(self.collect_dir, os.path.basename(path))])
+        finally:
+            results.close()
+        return row_counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Align and scan every subfolder of OMR sheets under a base directory.')
+    parser.add_argument('base_dir')
+    parser.add_argument('template_file')
+    parser.add_argument('--align', metavar='TEMPLATE_IMAGE', help='align new or changed sheets to this image before decoding them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes shared by all folders (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='realign and rescan every sheet, ignoring the manifests')
+    add_aligner_arguments(parser)
+    parser.add_argument('--keep-originals', action='store_true',
+                        help='do not write aligned sheets back over the originals (no alignment marker is written)')
+    parser.add_argument('--no-warp', action='store_true', help='with --keep-originals, warp only the template regions')
+    parser.add_argument('--collect', metavar='DIR', help='copy every <folder>.csv into this directory')
+    parser.add_argument('--fills', action='store_true',
+                        help='also write <folder>.fills.npz with per-bubble fill ratios and confidences')
+    parser.add_argument('--columnar', action='store_true',
+                        help='also write <folder>.parquet (with pyarrow) or <folder>.npz next to each CSV')
+    parser.add_argument('--prefetch', type=int, default=8, help='images to read and decode ahead in single-process mode (0 disables)')
+    parser.add_argument('--prefetch-mb', type=int, default=512, help='memory ceiling for prefetched images in MB (default: 512)')
+    args = parser.parse_args()
+    if args.no_warp and not (args.align and args.keep_originals):
+        parser.error('--no-warp needs --align and --keep-originals')
+    try:
+        aligner = aligner_from_args(args, args.align) if args.align else None
+        folder_pipeline = FolderPipeline(args.base_dir, args.template_file, aligner, args.workers, args.force,
+                                         not args.keep_originals, not args.no_warp, args.prefetch, args.prefetch_mb,
+                                         args.collect, args.fills, args.columnar)
+        row_counts = folder_pipeline.run()
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print("========================================")
+    for name, row_count in row_counts:
+        print(f"{name}: {row_count} rows")
+    print("All subfolders processed.")
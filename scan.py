@@ -3,207 +3,762 @@ import numpy as np
 import json
 import csv
 import os
+import hashlib
 import sys
+import base64
+import argparse
+import multiprocessing
+from manifest import ImageManifest, file_signature
+from loader import prefetch_images
+from align import REJECT_FILE, quality_fields, write_rejects, init_cv2_worker, add_aligner_arguments, aligner_from_args
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    COLUMNAR_SUFFIX = '.parquet'
+except ImportError:
+    # Optional; without it the columnar output is a NumPy .npz
+    pa = None
+    COLUMNAR_SUFFIX = '.npz'
+
+# Contour area above which read_sheet counts a bubble as marked (for QPSERIES, dark pixels)
+MIN_FILL = {'qpseries': 0, 'roll_number': 130, 'qbno': 130, 'questions': 80}
+FILL_GROUPS = ('qpseries', 'roll_number', 'qbno', 'questions')
+
+
+def option_rects(width, height):
+    # Four side-by-side option bubbles. Rects are x1, y1, x2, y2 with exclusive ends and, like
+    # the filled cv2.rectangle masks they replace, include the far edge of each option.
+    option_width = width // 4
+    rects = [(idx * option_width, 0, (idx + 1) * option_width + 1, height) for idx in range(3)]
+    rects.append((3 * option_width, 0, width, height))
+    return np.minimum(np.array(rects), [width, height, width, height])
+
+
+def qp_rects(width, height):
+    option_height = height // 4
+    rects = [(0, idx * option_height, width, (idx + 1) * option_height + 1) for idx in range(3)]
+    rects.append((0, 3 * option_height, width, height))
+    return np.minimum(np.array(rects), [width, height, width, height])
+
+
+def digit_rects(width, height):
+    rects = [(0, i * height // 10, width, (i + 1) * height // 10 + 1) for i in range(9)]
+    rects.append((0, 9 * height // 10, width, height))
+    return np.minimum(np.array(rects), [width, height, width, height])
+
+
+def fill_counts(integral, rects):
+    # Dark pixels inside each rect, four lookups per rect in the integral image of a 0/1 binary
+    x1, y1, x2, y2 = rects[..., 0], rects[..., 1], rects[..., 2], rects[..., 3]
+    return integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+
+
+def classify_fill(counts, min_area, labels):
+    marked = np.flatnonzero(counts > min_area)
+    if len(marked) == 0:
+        return 'X'
+    elif len(marked) > 1:
+        return '*'
+    else:
+        return labels[marked[0]]
+
+
+def classify_groups(counts, min_area, labels):
+    # Row-wise classify_fill over a (groups x bubbles) count matrix
+    marked = counts > min_area
+    marked_count = marked.sum(axis=-1)
+    first = np.array(list(labels))[marked.argmax(axis=-1)]
+    return np.where(marked_count == 0, 'X', np.where(marked_count > 1, '*', first)).tolist()
+
+
+class TemplateLayout:
+    # Compiled, read-only form of a .gs template. Every bubble is stored as an absolute
+    # x1, y1, x2, y2 sheet rect (exclusive ends), and the canvas that decode_sheet() lays the
+    # bubbles out on is planned once here rather than per sheet.
+    def __init__(self, template_data, image_shape=None):
+        question_regions = template_data.get('question_regions', [])
+        roll_number_regions = template_data.get('roll_number_regions', [])
+        qbno_regions = template_data.get('qbno_regions', [])
+        qpseries_region = template_data.get('qpseries_region', None)
+
+        self.question_boxes = region_boxes(question_regions)
+        self.roll_number_boxes = region_boxes(roll_number_regions)
+        self.qbno_boxes = region_boxes(qbno_regions)
+        self.question_rects = bubble_rects(question_regions, option_rects, 4)
+        self.roll_number_rects = bubble_rects(roll_number_regions, digit_rects, 10)
+        self.qbno_rects = bubble_rects(qbno_regions, digit_rects, 10)
+        self.question_count = len(question_regions)
+        self.qpseries_region = None
+        self.qpseries_rects = None
+        if qpseries_region is not None:
+            x1, y1, x2, y2 = (int(v) for v in qpseries_region)
+            self.qpseries_region = (x1, y1, x2, y2)
+            self.qpseries_rects = np.ascontiguousarray(qp_rects(max(0, x2 - x1), max(0, y2 - y1)), dtype=np.int32)
+        # Identifies the bubble geometry, so rows decoded with another template are not reused
+        digest = hashlib.sha1()
+        for rects in (self.qpseries_region or (), self.roll_number_rects, self.qbno_rects, self.question_rects):
+            rects = np.asarray(rects, dtype=np.int64)
+            digest.update(repr(rects.shape).encode('ascii') + rects.tobytes())
+        self.fingerprint = digest.hexdigest()
+        self.bubble_canvas = BubbleCanvas([(self.question_boxes, self.question_rects),
+                                           (self.roll_number_boxes, self.roll_number_rects),
+                                           (self.qbno_boxes, self.qbno_rects)])
+
+        if image_shape is not None:
+            self.validate(image_shape)
+        self._freeze()
+
+    @classmethod
+    def load(cls, template_file, reference_image=None):
+        with open(template_file, 'r') as file:
+            template_data = json.load(file)
+        image_shape = None
+        if reference_image is not None:
+            image = cv2.imread(reference_image, cv2.IMREAD_GRAYSCALE)
+            if image is None:
+                raise ValueError(f"Failed to load reference image: {reference_image}")
+            image_shape = image.shape
+        return cls(template_data, image_shape)
+
+    def validate(self, image_shape):
+        height, width = image_shape[:2]
+        problems = []
+        groups = [('QPSERIES', [self.qpseries_region] if self.qpseries_region else [], 4, 'tall'),
+                  ('Question', self.question_boxes, 4, 'wide'),
+                  ('ROLLNO', self.roll_number_boxes, 10, 'tall'),
+                  ('QBNO', self.qbno_boxes, 10, 'tall')]
+        for label, boxes, bubbles, direction in groups:
+            for number, (x1, y1, x2, y2) in enumerate(boxes, start=1):
+                if x1 < 0 or y1 < 0 or x2 > width or y2 > height:
+                    problems.append(f"{label} region {number} ({x1}, {y1}, {x2}, {y2}) is outside the {width}x{height} image")
+                elif (x2 - x1 if direction == 'wide' else y2 - y1) < bubbles or min(x2 - x1, y2 - y1) < 1:
+                    problems.append(f"{label} region {number} ({x1}, {y1}, {x2}, {y2}) is too small for {bubbles} bubbles")
+        if problems:
+            raise ValueError("Invalid template layout:\n" + "\n".join(problems))
+
+    def _freeze(self):
+        for value in self.__dict__.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        self.__dict__['_frozen'] = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen'):
+            raise AttributeError("TemplateLayout is immutable")
+        super().__setattr__(name, value)
+
+    def __setstate__(self, state):
+        # Unpickled arrays come back writeable; freeze them again in the worker
+        self.__dict__.update(state)
+        self._freeze()
+
+
+def region_boxes(regions):
+    boxes = [(x, y, x + w, y + h) for _, x, y, w, h in regions]
+    return np.array(boxes, dtype=np.int32).reshape(len(boxes), 4)
+
+
+def bubble_rects(regions, rects_for, bubbles):
+    rects = [rects_for(max(0, w), max(0, h)) + [x, y, x, y] for _, x, y, w, h in regions]
+    return np.ascontiguousarray(np.array(rects, dtype=np.int32).reshape(len(rects), bubbles, 4))
+
+
+class BubbleCanvas:
+    # Lays the bubbles of every blurred region out side by side, one blank pixel apart, in one
+    # binary image, so a single findContours() finds the marks of the whole sheet. Each bubble is
+    # copied on its own, like the masked crop of the contour decoder, so marks crossing into a
+    # neighbouring bubble are cut at its edge; the regions are laid out in rows, one per region.
+    def __init__(self, groups):
+        self.shapes = [rects.shape[:-1] for _, rects in groups]
+        self.regions = []
+        band_starts, slot_bands, slot_starts, slot_bubbles = [], [], [], []
+        bubble = 0
+        y = 1
+        width = 1
+        for boxes, rects in groups:
+            for (x1, y1, x2, y2), region_rects in zip(boxes, rects):
+                copies = []
+                x = 1
+                height = 0
+                for bx1, by1, bx2, by2 in region_rects - [x1, y1, x1, y1]:
+                    if bx2 > bx1 and by2 > by1:
+                        copies.append((by1, by2, bx1, bx2, y, x))
+                        slot_bands.append(len(band_starts))
+                        slot_starts.append(x)
+                        slot_bubbles.append(bubble)
+                        x += bx2 - bx1 + 1
+                        height = max(height, by2 - by1)
+                    bubble += 1
+                if copies:
+                    self.regions.append(((x1, y1, x2, y2), copies))
+                    band_starts.append(y)
+                    y += height + 1
+                    width = max(width, x)
+        self.shape = (y, width)
+        self.band_starts = np.array(band_starts, dtype=np.int64)
+        # Slots sorted by band, then x, so searchsorted() finds the slot of any canvas pixel
+        self.slot_keys = np.array(slot_bands, dtype=np.int64) * width + slot_starts
+        self.slot_bubbles = np.array(slot_bubbles, dtype=np.int64)
+        self.bubble_count = bubble
+
+    def areas(self, image):
+        # Area of the largest external contour in each bubble, or 0, per group. Each region is
+        # blurred and binarized on its own crop, as the contour decoder read it, so the blur
+        # reflects at the region edges. A region cut off by the sheet edge keeps what is on the
+        # sheet, and an empty one (still being drawn in IP_STEP3, or off the sheet) has no marks.
+        canvas = np.zeros(self.shape, dtype=np.uint8)
+        for (x1, y1, x2, y2), copies in self.regions:
+            cropped_image = image[y1:y2, x1:x2]
+            if cropped_image.size == 0:
+                continue
+            blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
+            _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
+            for by1, by2, bx1, bx2, cy, cx in copies:
+                bubble_image = binary_image[by1:by2, bx1:bx2]
+                canvas[cy:cy + bubble_image.shape[0], cx:cx + bubble_image.shape[1]] = bubble_image
+        contours, _ = cv2.findContours(canvas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        areas = np.zeros(self.bubble_count)
+        if contours:
+            # Every contour point lies in its bubble's slot
+            points = np.array([contour[0, 0] for contour in contours], dtype=np.int64)
+            bands = np.searchsorted(self.band_starts, points[:, 1], 'right') - 1
+            slots = np.searchsorted(self.slot_keys, bands * self.shape[1] + points[:, 0], 'right') - 1
+            np.maximum.at(areas, self.slot_bubbles[slots], [cv2.contourArea(contour) for contour in contours])
+        groups = []
+        start = 0
+        for shape in self.shapes:
+            count = int(np.prod(shape))
+            groups.append(areas[start:start + count].reshape(shape))
+            start += count
+        return groups
+
+
+def decode_sheet(image, layout):
+    # Per-bubble fills: the largest mark's contour area, the measure MIN_FILL thresholds
+    question_areas, roll_number_areas, qbno_areas = layout.bubble_canvas.areas(image)
+    fills = {
+        'questions': question_areas,
+        'roll_number': roll_number_areas,
+        'qbno': qbno_areas,
+        'qpseries': np.zeros(4, dtype=np.int64),
+    }
+
+    # QPSERIES is read unblurred at a darker threshold, and any dark pixel marks a bubble
+    if layout.qpseries_region is not None:
+        x1, y1, x2, y2 = layout.qpseries_region
+        cropped_image = image[y1:y2, x1:x2]
+        if cropped_image.size:
+            _, qp_binary = cv2.threshold(cropped_image, 50, 1, cv2.THRESH_BINARY_INV)
+            height, width = cropped_image.shape
+            fills['qpseries'] = fill_counts(cv2.integral(qp_binary), np.minimum(layout.qpseries_rects, [width, height, width, height]))
+    return fills
+
+
+class PatchAtlas:
+    # Lets a sheet be decoded without warping the whole scan. Every template region plus a small
+    # margin gets a slot in one small atlas image; per sheet, each region is warped straight from
+    # the raw scan into its slot and the atlas is read with a layout in atlas coordinates.
+    def __init__(self, layout, margin=2, width=1024):
+        regions = [('question_regions', box) for box in layout.question_boxes]
+        regions += [('roll_number_regions', box) for box in layout.roll_number_boxes]
+        regions += [('qbno_regions', box) for box in layout.qbno_boxes]
+        if layout.qpseries_region is not None:
+            regions.append(('qpseries_region', layout.qpseries_region))
+
+        # Shelf packing, tallest slots first
+        order = sorted(range(len(regions)), key=lambda i: regions[i][1][3] - regions[i][1][1], reverse=True)
+        width = max([width] + [int(x2 - x1) + 2 * margin for _, (x1, _, x2, _) in regions])
+        slots = [None] * len(regions)
+        x = y = shelf_height = used_width = 0
+        for i in order:
+            x1, y1, x2, y2 = (int(v) for v in regions[i][1])
+            slot_width, slot_height = max(0, x2 - x1) + 2 * margin, max(0, y2 - y1) + 2 * margin
+            if x + slot_width > width:
+                x, y, shelf_height = 0, y + shelf_height, 0
+            slots[i] = (x1 - margin, y1 - margin, x, y, slot_width, slot_height)
+            x += slot_width
+            shelf_height = max(shelf_height, slot_height)
+            used_width = max(used_width, x)
+        self.shape = (y + shelf_height, used_width)
+        self.slots = slots
+
+        template_data = {'question_regions': [], 'roll_number_regions': [], 'qbno_regions': []}
+        for (key, (x1, y1, x2, y2)), (_, _, x, y, _, _) in zip(regions, slots):
+            x, y = x + margin, y + margin
+            if key == 'qpseries_region':
+                template_data[key] = [x, y, x + x2 - x1, y + y2 - y1]
+            else:
+                template_data[key].append([len(template_data[key]) + 1, x, y, int(x2 - x1), int(y2 - y1)])
+        self.layout = TemplateLayout(template_data)
+
+    def sample(self, image, h):
+        # h maps the raw sheet onto the template, as from TemplateAligner.find_homography
+        atlas = np.zeros(self.shape, dtype=np.uint8)
+        for source_x, source_y, x, y, slot_width, slot_height in self.slots:
+            shift = np.array([[1, 0, -source_x], [0, 1, -source_y], [0, 0, 1]], dtype=np.float64)
+            atlas[y:y + slot_height, x:x + slot_width] = cv2.warpPerspective(image, shift @ h, (slot_width, slot_height))
+        return atlas
+
+
+def classify_sheet(fills):
+    qpseries_response = classify_fill(fills['qpseries'], MIN_FILL['qpseries'], 'ABCD')
+    roll_number_responses = classify_groups(fills['roll_number'], MIN_FILL['roll_number'], '0123456789')
+    qbno_responses = classify_groups(fills['qbno'], MIN_FILL['qbno'], '0123456789')
+    question_responses = classify_groups(fills['questions'], MIN_FILL['questions'], 'ABCD')
+    return qpseries_response, roll_number_responses, qbno_responses, question_responses
+
+
+def read_sheet(image, layout):
+    return classify_sheet(decode_sheet(image, layout))
+
+
+def bubble_areas(layout):
+    # Pixel area of every bubble, shaped like the decode_sheet() counts of its group
+    areas = {}
+    rects = (layout.qpseries_rects, layout.roll_number_rects, layout.qbno_rects, layout.question_rects)
+    for group, group_rects in zip(FILL_GROUPS, rects):
+        if group_rects is None:
+            areas[group] = np.ones(4)
+        else:
+            areas[group] = np.maximum(1, (group_rects[..., 2] - group_rects[..., 0]) * (group_rects[..., 3] - group_rects[..., 1]))
+    return areas
+
+
+def fill_ratios(fills, layout):
+    # decode_sheet() counts as the dark share of each bubble (0-255), flattened in FILL_GROUPS
+    # order: the compact per-sheet evidence behind the letters
+    areas = bubble_areas(layout)
+    ratios = np.concatenate([fills[group].ravel() * 255 / areas[group].ravel() for group in FILL_GROUPS])
+    return np.clip(np.rint(ratios), 0, 255).astype(np.uint8)
+
+
+def split_fills(ratios, layout):
+    # Undoes the flattening of fill_ratios() for one sheet or a (sheets x ratios) array
+    ratios = np.asarray(ratios)
+    groups = {}
+    start = 0
+    for group, areas in bubble_areas(layout).items():
+        groups[group] = ratios[..., start:start + areas.size].reshape(ratios.shape[:-1] + areas.shape)
+        start += areas.size
+    return groups
+
+
+def fill_confidence(ratios, layout):
+    # How far each bubble is from the marked/unmarked threshold, relative to the threshold and
+    # capped at 1. A question or digit is as confident as its least clear bubble, and the sheet
+    # as its least clear question or digit. QPSERIES marks by any dark pixel, so its confidence is
+    # instead how far its darkest bubble stands out from the next one: 1 for a single clean mark,
+    # 0 for none or two equal ones. Returns (question, sheet, QPSERIES confidences).
+    areas = bubble_areas(layout)
+    groups = split_fills(ratios, layout)
+    confidence = {}
+    for group in ('roll_number', 'qbno', 'questions'):
+        counts = groups[group] * areas[group] / 255.0
+        margin = np.abs(counts - MIN_FILL[group]) / MIN_FILL[group]
+        confidence[group] = np.minimum(1, margin).min(axis=-1, initial=1.0)
+    sheet = np.minimum.reduce([values.min(axis=-1, initial=1.0) for values in confidence.values()])
+    darkest = np.sort(groups['qpseries'].astype(float), axis=-1)
+    qpseries = (darkest[..., -1] - darkest[..., -2]) / np.maximum(1, darkest[..., -1])
+    return confidence['questions'], sheet, qpseries
+
+
+def fills_path(output_csv):
+    return os.path.splitext(output_csv)[0] + '.fills.npz'
+
+
+def write_fills(fills_file, image_paths, ratios, layout):
+    # --fills sidecar: per-bubble fill ratios and confidences for the CSV rows, in row order
+    ratios = np.array(ratios, dtype=np.uint8).reshape(len(image_paths), -1)
+    question_confidence, confidence, qpseries_confidence = fill_confidence(ratios, layout)
+    arrays = dict(split_fills(ratios, layout), image=np.array(image_paths, dtype=str),
+                  question_confidence=question_confidence.astype(np.float32), confidence=confidence.astype(np.float32),
+                  qpseries_confidence=qpseries_confidence.astype(np.float32))
+    tmp_path = fills_file + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, fills_file)
+    return confidence
+
+
+def columnar_path(output_csv):
+    return os.path.splitext(output_csv)[0] + COLUMNAR_SUFFIX
+
+
+def sidecar_paths(output_csv):
+    # Every file --columnar or --fills may have written next to a CSV, in either columnar format,
+    # in the order they are written: the fills sidecar last, so it is never older than its CSV
+    base = os.path.splitext(output_csv)[0]
+    return [base + '.parquet', base + '.npz', fills_path(output_csv)]
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def write_columnar(output_csv, columnar_file):
+    # --columnar copy of a results CSV, for disc_v7.py and aggregating folders without parsing text.
+    # ROLLNO and QBNO stay strings; QPSERIES and the answers become int8 codes into one shared list
+    # of labels (-1 for an empty cell, as in a pandas Categorical), and image paths codes into the
+    # distinct paths. Written as dictionary-encoded Parquet with pyarrow, else as an .npz with those
+    # arrays. Returns the row count.
+    rollnos, qbnos, answers, images = [], [], bytearray(), []
+    with open(output_csv, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        for row in reader:
+            # Every QPSERIES and answer cell holds a single character, unless edited by hand
+            cells = row[2:-1]
+            codes = ''.join(cells).encode('ascii')
+            if len(codes) != len(cells):
+                codes = ''.join(cell or '\0' for cell in cells).encode('ascii')
+            if len(row) != len(columns) or len(codes) != len(cells):
+                raise ValueError(f"{output_csv} is not a scan.py results file (line {reader.line_num})")
+            rollnos.append(row[0])
+            qbnos.append(row[1])
+            answers += codes
+            images.append(row[-1])
+    labels, codes = np.unique(np.frombuffer(bytes(answers), np.uint8), return_inverse=True)
+    codes = codes.astype(np.int8).reshape(len(rollnos), len(columns) - 3)
+    if len(labels) and labels[0] == 0:
+        # Empty cells sort first
+        labels, codes = labels[1:], codes - 1
+    labels = np.array([chr(label) for label in labels], dtype=str)
+    images, image_codes = np.unique(np.array(images, dtype=str), return_inverse=True)
+
+    tmp_path = columnar_file + '.tmp'
+    if columnar_file.endswith('.parquet'):
+        arrays = [pa.array(rollnos, pa.string()), pa.array(qbnos, pa.string())]
+        arrays += [pa.DictionaryArray.from_arrays(pa.array(codes[:, i], mask=codes[:, i] < 0), labels)
+                   for i in range(codes.shape[1])]
+        arrays.append(pa.DictionaryArray.from_arrays(image_codes.astype(np.uint32), images))
+        pq.write_table(pa.table(arrays, names=columns), tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, columns=np.array(columns, dtype=str), ROLLNO=np.array(rollnos, dtype=str),
+                                QBNO=np.array(qbnos, dtype=str), codes=codes, labels=labels,
+                                image_codes=image_codes.astype(np.uint32), images=images)
+    os.replace(tmp_path, columnar_file)
+    return len(rollnos)
+
+
+class CsvStreamWriter:
+    # Rows go to <output_csv>.tmp as they are produced and the file only replaces output_csv once
+    # it is complete, so readers never see a half-written CSV. After a crash the .tmp keeps the
+    # rows written so far.
+    def __init__(self, output_csv, header, flush_every=100):
+        self.output_csv = output_csv
+        self.tmp_path = output_csv + '.tmp'
+        self.flush_every = flush_every
+        self.row_count = 0
+        self.discarded = False
+        self.file = open(self.tmp_path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.row_count += 1
+        if self.row_count % self.flush_every == 0:
+            self.file.flush()
+
+    def discard(self):
+        self.discarded = True
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if self.discarded:
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.output_csv)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            print(f"Scan interrupted; {self.row_count} rows kept in {self.tmp_path}")
+        return False
+
+
+def scan_file(image_path, layout, cv_image=None, aligner=None, write_aligned=False, atlas=None):
+    # Returns (image_path, responses, status, fills), fills being the fill_ratios() of a decoded
+    # sheet; for a 'rejected' sheet responses is the reason and alignment quality instead. With an
+    # aligner the sheet is warped in memory and decoded straight from the aligned array; it is only
+    # written back when write_aligned is set. With an atlas only the template regions are warped
+    # and the full aligned sheet is never built.
+    if cv_image is None:
+        cv_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if cv_image is None:
+        return image_path, None, 'unreadable', None
+    status = 'scanned'
+    if aligner is not None:
+        estimate = aligner.estimate(cv_image)
+        h = estimate['homography']
+        if h is None:
+            return image_path, None, 'unaligned', None
+        if estimate['reject_reason']:
+            return image_path, (estimate['reject_reason'], quality_fields(estimate)), 'rejected', None
+        if atlas is not None and not write_aligned:
+            fills = decode_sheet(atlas.sample(cv_image, h), atlas.layout)
+            return image_path, classify_sheet(fills), 'aligned', fill_ratios(fills, atlas.layout)
+        cv_image = aligner.warp(cv_image, h)
+        status = 'aligned'
+        if write_aligned:
+            cv2.imwrite(image_path, cv_image)
+            status = 'written'
+    fills = decode_sheet(cv_image, layout)
+    return image_path, classify_sheet(fills), status, fill_ratios(fills, layout)
+
+
+_worker_layout = None
+_worker_aligner = None
+_worker_write_aligned = False
+_worker_atlas = None
+
+
+def init_worker(layout, aligner, write_aligned, atlas):
+    # Pool initializer for scan_worker(), which decodes (image_path, needs_alignment) tasks
+    global _worker_layout, _worker_aligner, _worker_write_aligned, _worker_atlas
+    init_cv2_worker()
+    _worker_layout = layout
+    _worker_aligner = aligner
+    _worker_write_aligned = write_aligned
+    _worker_atlas = atlas
+
+
+def scan_worker(task):
+    image_path, needs_alignment = task
+    aligner = _worker_aligner if needs_alignment else None
+    return scan_file(image_path, _worker_layout, aligner=aligner, write_aligned=_worker_write_aligned,
+                     atlas=_worker_atlas)
+
+
+def csv_header(layout):
+    return ['ROLLNO', 'QBNO', 'QPSERIES'] + [f'A{i}' for i in range(1, layout.question_count + 1)] + ['Front side Image']
+
+
+def response_row(responses):
+    # CSV row, without the image path, for read_sheet() responses
+    qpseries_response, roll_number_responses, qbno_responses, question_responses = responses
+    return [''.join(roll_number_responses), ''.join(qbno_responses), qpseries_response] + question_responses
+
+
+def decode_images(tasks, layout, aligner=None, write_aligned=False, atlas=None, workers=1, prefetch=8, prefetch_mb=512):
+    # Yields scan_file results for (image_path, needs_alignment) tasks, in task order
+    if workers > 1:
+        initargs = (layout, aligner, write_aligned, atlas)
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            yield from pool.imap(scan_worker, tasks, chunksize=8)
+    else:
+        # Decode the next images on background threads while the current one is read
+        prefetched = prefetch_images([image_path for image_path, _ in tasks], prefetch, prefetch_mb)
+        for (image_path, cv_image), (_, align) in zip(prefetched, tasks):
+            yield scan_file(image_path, layout, cv_image, aligner if align else None, write_aligned, atlas)
+
 
 class OMRScanner:
-    def __init__(self, template_file, image_dir, output_csv):
+    def __init__(self, template_file, image_dir, output_csv, reference_image=None, workers=1, rescan=False,
+                 prefetch=8, prefetch_mb=512, aligner=None, write_aligned=False, warp=True,
+                 include_rejected=False, realign=False, fills=False, columnar=False):
         self.template_file = template_file
         self.image_dir = image_dir
         self.output_csv = output_csv
-        self.qpseries_region = None
-        self.question_regions = []
-        self.roll_number_regions = []
-        self.qbno_regions = []
+        self.reference_image = reference_image
+        self.workers = workers
+        self.rescan = rescan
+        self.prefetch = prefetch
+        self.prefetch_mb = prefetch_mb
+        self.aligner = aligner
+        self.write_aligned = write_aligned
+        self.include_rejected = include_rejected
+        self.realign = realign
+        self.fills = fills
+        self.columnar = columnar
+        self.layout = None
+        self.atlas = None
+        self.manifest = None
+        self.image_files = []
+        self.cached_rows = {}
         self.load_template()
+        if aligner is not None and not warp:
+            self.atlas = PatchAtlas(self.layout)
 
     def load_template(self):
-        with open(self.template_file, 'r') as file:
-            template_data = json.load(file)
-            self.qpseries_region = template_data.get('qpseries_region', None)
-            self.question_regions = template_data.get('question_regions', [])
-            self.roll_number_regions = template_data.get('roll_number_regions', [])
-            self.qbno_regions = template_data.get('qbno_regions', [])
+        self.layout = TemplateLayout.load(self.template_file, self.reference_image)
         print(f"Template loaded from {self.template_file}")
 
-    def detect_shaded_option_qp(self, cropped_image):
-        if cropped_image is None or not isinstance(cropped_image, np.ndarray):
-            return 'X'
-        _, binary_image = cv2.threshold(cropped_image, 50, 255, cv2.THRESH_BINARY_INV)
-        height, width = cropped_image.shape
-        option_height = height // 4
-        option_regions = [
-            (0, 0, width, option_height),
-            (0, option_height, width, 2 * option_height),
-            (0, 2 * option_height, width, 3 * option_height),
-            (0, 3 * option_height, width, height)
-        ]
-        detected_options = []
-        for idx, (x1, y1, x2, y2) in enumerate(option_regions):
-            option_mask = np.zeros((height, width), dtype=np.uint8)
-            cv2.rectangle(option_mask, (x1, y1), (x2, y2), 255, -1)
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=option_mask)
-            option_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if option_contours:
-                detected_options.append(chr(65 + idx))
-        if len(detected_options) == 0:
-            return 'X'
-        elif len(detected_options) > 1:
-            return '*'
-        else:
-            return detected_options[0]
-
-    def detect_shaded_option(self, cropped_image):
-        blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
-        _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
-        height, width = cropped_image.shape
-        option_width = width // 4
-        option_regions = [
-            (0, 0, option_width, height),
-            (option_width, 0, 2 * option_width, height),
-            (2 * option_width, 0, 3 * option_width, height),
-            (3 * option_width, 0, width, height)
-        ]
-        detected_options = []
-        for idx, (x1, y1, x2, y2) in enumerate(option_regions):
-            option_mask = np.zeros_like(binary_image)
-            cv2.rectangle(option_mask, (x1, y1), (x2, y2), 255, -1)
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=option_mask)
-            option_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for contour in option_contours:
-                area = cv2.contourArea(contour)
-                if area > 80:
-                    detected_options.append(chr(ord('A') + idx))
-                    break
-        if len(detected_options) == 0:
-            return 'X'
-        elif len(detected_options) > 1:
-            return '*'
-        else:
-            return detected_options[0]
-
-    def detect_shaded_roll_number(self, cropped_image):
-        blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
-        _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
-        height, width = cropped_image.shape
-        bubble_regions = []
-        for i in range(10):
-            y_start = i * height // 10
-            y_end = (i + 1) * height // 10
-            bubble_regions.append((0, y_start, width, y_end))
-        detected_digits = []
-        for digit, (x1, y1, x2, y2) in enumerate(bubble_regions):
-            bubble_mask = np.zeros_like(binary_image)
-            cv2.rectangle(bubble_mask, (x1, y1), (x2, y2), 255, -1)
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=bubble_mask)
-            bubble_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if bubble_contours:
-                for contour in bubble_contours:
-                    area = cv2.contourArea(contour)
-                    if area > 130:
-                        detected_digits.append(str(digit))
-                        break
-        if len(detected_digits) == 0:
-            return 'X'
-        elif len(detected_digits) > 1:
-            return '*'
-        else:
-            return detected_digits[0]
-
-    def detect_shaded_qbno(self, cropped_image):
-        blurred_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
-        _, binary_image = cv2.threshold(blurred_image, 100, 255, cv2.THRESH_BINARY_INV)
-        height, width = cropped_image.shape
-        bubble_regions = []
-        for i in range(10):
-            y_start = i * height // 10
-            y_end = (i + 1) * height // 10
-            bubble_regions.append((0, y_start, width, y_end))
-        detected_digits = []
-        for digit, (x1, y1, x2, y2) in enumerate(bubble_regions):
-            bubble_mask = np.zeros_like(binary_image)
-            cv2.rectangle(bubble_mask, (x1, y1), (x2, y2), 255, -1)
-            intersection = cv2.bitwise_and(binary_image, binary_image, mask=bubble_mask)
-            bubble_contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if bubble_contours:
-                for contour in bubble_contours:
-                    area = cv2.contourArea(contour)
-                    if area > 130:
-                        detected_digits.append(str(digit))
-                        break
-        if len(detected_digits) == 0:
-            return 'X'
-        elif len(detected_digits) > 1:
-            return '*'
-        else:
-            return detected_digits[0]
+    def read_sheet(self, cv_image):
+        return read_sheet(cv_image, self.layout)
 
-    def scan_images(self):
-        csv_data = []
-        image_paths = []
-        
-        # Recursively collect all F.jpg files
+    def find_images(self):
+        # Recursively collect all F.jpg files, sorted so rows come out in a stable order
         image_files = []
         for root, dirs, files in os.walk(self.image_dir):
             for file in files:
                 if file.lower().endswith('f.jpg'):
                     image_files.append(os.path.join(root, file))
-        
+        return sorted(image_files)
+
+    def read_images(self, tasks):
+        return decode_images(tasks, self.layout, self.aligner, self.write_aligned, self.atlas, self.workers,
+                             self.prefetch, self.prefetch_mb)
+
+    def header(self):
+        return csv_header(self.layout)
+
+    def prepare(self):
+        # Opens the manifest and returns the (image_path, needs_alignment) tasks still to decode,
+        # or None if the folder has no sheets. write_results() consumes their results.
+        image_files = self.find_images()
         if not image_files:
             print(f"No F.jpg files found in {self.image_dir} or its subfolders")
-            return []
-        
-        print(f"Found {len(image_files)} images to process")
-        for image_path in image_files:
-            image_paths.append(image_path)
-            cv_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-            if cv_image is None:
-                print(f"Failed to load image: {image_path}")
-                continue
-            qpseries_response = self.detect_shaded_option_qp(
-                cv_image[self.qpseries_region[1]:self.qpseries_region[3],
-                        self.qpseries_region[0]:self.qpseries_region[2]]
-            )
-            roll_number_responses = [
-                self.detect_shaded_roll_number(cv_image[y:y+h, x:x+w])
-                for _, x, y, w, h in self.roll_number_regions
-            ]
-            question_responses = [
-                self.detect_shaded_option(cv_image[y:y+h, x:x+w])
-                for _, x, y, w, h in self.question_regions
-            ]
-            qbno_responses = [
-                self.detect_shaded_qbno(cv_image[y:y+h, x:x+w])
-                for _, x, y, w, h in self.qbno_regions
-            ]
-            roll_number_str = ''.join(roll_number_responses)
-            qbno_str = ''.join(qbno_responses)
-            row = [roll_number_str, qbno_str, qpseries_response] + question_responses + [image_path]
-            csv_data.append(row)
-            print(f"Processed: {os.path.basename(image_path)} - ROLLNO: {roll_number_str}, QBNO: {qbno_str}, QPSERIES: {qpseries_response}")
-        
-        if csv_data:
-            with open(self.output_csv, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                header = ['ROLLNO', 'QBNO', 'QPSERIES'] + [f'A{i}' for i in range(1, len(self.question_regions) + 1)] + ['Front side Image']
-                writer.writerow(header)
-                for row in csv_data:
-                    writer.writerow(row)
+            return None
+
+        # Sheets unchanged since their last scan reuse the recorded row; only the rest are decoded
+        manifest = ImageManifest(self.image_dir)
+        if not self.include_rejected:
+            # Sheets in the alignment reject queue would only decode into wrong answers
+            accepted = [image_path for image_path in image_files if not manifest.is_rejected(image_path)]
+            if len(accepted) < len(image_files):
+                print(f"Skipping {len(image_files) - len(accepted)} images rejected at alignment")
+            image_files = accepted
+        cached_rows = {}
+        if not self.rescan:
+            for image_path in image_files:
+                row = manifest.scanned_row(image_path, self.layout.fingerprint)
+                # With --fills, rows scanned without recording their fill ratios are decoded again
+                if row is not None and (not self.fills or manifest.get(image_path).get('fills')):
+                    cached_rows[image_path] = row
+        pending = [image_path for image_path in image_files if image_path not in cached_rows]
+        print(f"Found {len(image_files)} images, {len(pending)} to process")
+        self.manifest = manifest
+        self.image_files = image_files
+        self.cached_rows = cached_rows
+
+        # In align+scan mode, sheets already aligned on disk are decoded as they are
+        return [(image_path, self.aligner is not None and (self.realign or not manifest.is_aligned(image_path)))
+                for image_path in pending]
+
+    def scan_images(self):
+        tasks = self.prepare()
+        if tasks is None:
+            return 0
+        results = self.read_images(tasks)
+        try:
+            return self.write_results(results)
+        finally:
+            results.close()
+
+    def write_results(self, results):
+        # Streams the cached rows and one result per pending sheet, in path order, into output_csv.
+        # results may carry on with other folders' sheets; only this folder's are taken from it.
+        manifest = self.manifest
+        fill_images = []
+        fill_rows = []
+        try:
+            with CsvStreamWriter(self.output_csv, self.header()) as writer:
+                for image_path in self.image_files:
+                    if image_path in self.cached_rows:
+                        writer.writerow(self.cached_rows[image_path] + [image_path])
+                        if self.fills:
+                            fill_images.append(image_path)
+                            fill_rows.append(np.frombuffer(base64.b64decode(manifest.get(image_path)['fills']), np.uint8))
+                        continue
+                    _, responses, status, fills = next(results)
+                    if status == 'unreadable':
+                        print(f"Failed to load image: {image_path}")
+                        continue
+                    if status == 'unaligned':
+                        print(f"Failed to align image: {image_path}")
+                        manifest.record(image_path, align_status='failed')
+                        continue
+                    if status == 'rejected':
+                        reason, quality = responses
+                        print(f"Rejected image: {image_path} ({reason})")
+                        manifest.record(image_path, rejected=file_signature(image_path), align_status='rejected',
+                                        reject_reason=reason, **quality)
+                        continue
+                    if status == 'written':
+                        manifest.record(image_path, aligned=file_signature(image_path), align_status='ok')
+                    row = response_row(responses)
+                    writer.writerow(row + [image_path])
+                    # A scan without --fills clears the ratios of the file's previous version
+                    encoded = base64.b64encode(fills.tobytes()).decode('ascii') if self.fills else None
+                    manifest.record(image_path, scanned=file_signature(image_path), template=self.layout.fingerprint,
+                                    row=row, fills=encoded)
+                    if self.fills:
+                        fill_images.append(image_path)
+                        fill_rows.append(fills)
+                    print(f"Processed: {os.path.basename(image_path)} - ROLLNO: {row[0]}, QBNO: {row[1]}, QPSERIES: {row[2]}")
+                if writer.row_count == 0:
+                    writer.discard()
+        finally:
+            manifest.close()
+        if self.aligner is not None:
+            queued = write_rejects(manifest, os.path.join(self.image_dir, REJECT_FILE))
+            if queued:
+                print(f"{queued} rejected sheet(s) listed in {os.path.join(self.image_dir, REJECT_FILE)}")
+
+        if writer.row_count:
             print(f"Responses saved to {self.output_csv}")
-            print(f"Total images processed: {len(csv_data)}")
+            print(f"Total images processed: {writer.row_count}")
+            written = []
+            if self.columnar:
+                write_columnar(self.output_csv, columnar_path(self.output_csv))
+                written.append(columnar_path(self.output_csv))
+                print(f"Columnar copy saved to {columnar_path(self.output_csv)}")
+            if self.fills:
+                confidence = write_fills(fills_path(self.output_csv), fill_images, fill_rows, self.layout)
+                written.append(fills_path(self.output_csv))
+                print(f"Fill ratios saved to {fills_path(self.output_csv)}; "
+                      f"{int((confidence < 0.5).sum())} sheet(s) with confidence below 0.5")
+            # Sidecars of an earlier run would no longer match the rows of the new CSV
+            remove_files([path for path in sidecar_paths(self.output_csv) if path not in written])
         else:
             print("No data to save")
-        return csv_data
+        return writer.row_count
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python omr_scan_auto.py <template_file> <image_dir> <output_csv>")
-        sys.exit(1)
-    template_file = sys.argv[1]
-    image_dir = sys.argv[2]
-    output_csv = sys.argv[3]
+    parser = argparse.ArgumentParser(description='Read OMR answer sheets (*F.jpg) into a CSV file.')
+    parser.add_argument('template_file')
+    parser.add_argument('image_dir')
+    parser.add_argument('output_csv')
+    parser.add_argument('--reference-image', help='check every template region lies inside this image before scanning')
+    parser.add_argument('--workers', type=int, default=1, help='number of decoding processes (default: 1)')
+    parser.add_argument('--rescan', action='store_true', help='decode every image, ignoring rows recorded in the manifest')
+    parser.add_argument('--prefetch', type=int, default=8, help='images to read and decode ahead in single-process mode (0 disables)')
+    parser.add_argument('--prefetch-mb', type=int, default=512, help='memory ceiling for prefetched images in MB (default: 512)')
+    parser.add_argument('--align', metavar='TEMPLATE_IMAGE',
+                        help='align each sheet to this image in memory and decode the aligned array (single pass)')
+    add_aligner_arguments(parser)
+    parser.add_argument('--write-aligned', action='store_true', help='with --align, also write each aligned sheet back over the original')
+    parser.add_argument('--include-rejected', action='store_true', help='also decode sheets rejected at alignment')
+    parser.add_argument('--no-warp', action='store_true',
+                        help='with --align, warp only the template regions instead of the whole sheet')
+    parser.add_argument('--fills', action='store_true',
+                        help='also write per-bubble fill ratios and confidences to <output>.fills.npz')
+    parser.add_argument('--columnar', action='store_true',
+                        help='also write the results as <output>.parquet (with pyarrow) or <output>.npz')
+    args = parser.parse_args()
+    if args.no_warp and (not args.align or args.write_aligned):
+        parser.error('--no-warp needs --align and cannot be combined with --write-aligned')
     try:
-        scanner = OMRScanner(template_file, image_dir, output_csv)
+        aligner = aligner_from_args(args, args.align) if args.align else None
+        scanner = OMRScanner(args.template_file, args.image_dir, args.output_csv, args.reference_image, args.workers,
+                             args.rescan, args.prefetch, args.prefetch_mb, aligner, args.write_aligned,
+                             not args.no_warp, args.include_rejected, fills=args.fills,
+                             columnar=args.columnar)
         scanner.scan_images()
     except Exception as e:
         print(f"Error: {e}")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from scan import TemplateLayout, read_sheet  # noqa: E402
+
+TEMPLATE_FILE = os.path.join(ROOT, 'jssc.gs')
+SAMPLE_SHEET = os.path.join(ROOT, '2024.07.18 12.29.42F.jpg')
+
+
+# Reference: the original per-option contour decoder, kept as it was written
+def contour_option(cropped_image, regions, blur, threshold, min_area, labels):
+    if blur:
+        cropped_image = cv2.GaussianBlur(cropped_image, (5, 5), 0)
+    _, binary_image = cv2.threshold(cropped_image, threshold, 255, cv2.THRESH_BINARY_INV)
+    detected = []
+    for idx, (x1, y1, x2, y2) in enumerate(regions):
+        mask = np.zeros_like(binary_image)
+        cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
+        intersection = cv2.bitwise_and(binary_image, binary_image, mask=mask)
+        contours, _ = cv2.findContours(intersection, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # QPSERIES takes any contour at all
+        if contours and (min_area is None or max(cv2.contourArea(contour) for contour in contours) > min_area):
+            detected.append(labels[idx])
+    if len(detected) == 0:
+        return 'X'
+    return '*' if len(detected) > 1 else detected[0]
+
+
+def contour_read(image, template):
+    def wide(crop):
+        height, width = crop.shape
+        w = width // 4
+        return contour_option(crop, [(0, 0, w, height), (w, 0, 2 * w, height), (2 * w, 0, 3 * w, height),
+                                     (3 * w, 0, width, height)], True, 100, 80, 'ABCD')
+
+    def digits(crop):
+        height, width = crop.shape
+        regions = [(0, i * height // 10, width, (i + 1) * height // 10) for i in range(10)]
+        return contour_option(crop, regions, True, 100, 130, '0123456789')
+
+    x1, y1, x2, y2 = template['qpseries_region']
+    crop = image[y1:y2, x1:x2]
+    height, width = crop.shape
+    h = height // 4
+    qpseries = contour_option(crop, [(0, 0, width, h), (0, h, width, 2 * h), (0, 2 * h, width, 3 * h),
+                                     (0, 3 * h, width, height)], False, 50, None, 'ABCD')
+    return (qpseries,
+            [digits(image[y:y + h, x:x + w]) for _, x, y, w, h in template['roll_number_regions']],
+            [digits(image[y:y + h, x:x + w]) for _, x, y, w, h in template['qbno_regions']],
+            [wide(image[y:y + h, x:x + w]) for _, x, y, w, h in template['question_regions']])
+
+
+def draw_marks(image, template, kind, rng, count=60):
+    # Marks near the thresholds, across bubble and region edges
+    image = image.copy()
+    boxes = [(x, y, x + w, y + h) for key in ('question_regions', 'roll_number_regions', 'qbno_regions')
+             for _, x, y, w, h in template[key]]
+    for index in rng.choice(len(boxes), count, replace=False):
+        x1, y1, x2, y2 = boxes[index]
+        x, y = int(rng.integers(x1 - 3, x2 - 2)), int(rng.integers(y1 - 3, y2 - 2))
+        if kind == 'blob':
+            width, height = rng.integers(8, 14, 2)
+            image[y:y + height, x:x + width] = 0
+        elif kind == 'specks':
+            for _ in range(6):
+                sx, sy = rng.integers(x1, x2 - 3), rng.integers(y1, y2 - 3)
+                image[sy:sy + 3, sx:sx + 3] = 0
+        elif kind == 'ring':
+            cv2.rectangle(image, (x, y), (x + 13, y + 13), 0, 1)
+        elif kind == 'grey':
+            image[y:y + 12, x:x + 12] = rng.integers(80, 130)
+    return image
+
+
+@pytest.fixture(scope='module')
+def sheet():
+    with open(TEMPLATE_FILE) as f:
+        template = json.load(f)
+    return template, TemplateLayout(template), cv2.imread(SAMPLE_SHEET, cv2.IMREAD_GRAYSCALE)
+
+
+def test_sample_sheet_matches_contour_decoder(sheet):
+    template, layout, image = sheet
+    assert read_sheet(image, layout) == contour_read(image, template)
+
+
+@pytest.mark.parametrize('kind', ['blob', 'specks', 'ring', 'grey'])
+def test_marks_match_contour_decoder(sheet, kind):
+    template, layout, image = sheet
+    rng = np.random.default_rng(0)
+    for _ in range(4):
+        marked = draw_marks(image, template, kind, rng)
+        assert read_sheet(marked, layout) == contour_read(marked, template)
+
+
+def test_near_threshold_blob(sheet):
+    # A solid 9x10 blob binarizes to 86 dark pixels, but its contour area is only 70, under the 80 threshold
+    template, layout, image = sheet
+    _, x, y, w, h = template['question_regions'][0]
+    marked = image.copy()
+    marked[y + 2:y + h - 2, x:x + w] = 255
+    marked[y + 3:y + 13, x + 2:x + 11] = 0
+    assert read_sheet(marked, layout)[3][0] == contour_read(marked, template)[3][0] == 'X'
+
+
+def test_partial_layouts(sheet):
+    # IP_STEP3 previews whatever regions have been drawn so far
+    template, _, image = sheet
+    qpseries_only = TemplateLayout({'qpseries_region': template['qpseries_region']})
+    assert read_sheet(image, qpseries_only) == (contour_read(image, template)[0], [], [], [])
+    empty_question = TemplateLayout({'question_regions': [[1, 172, 825, 0, 33]]})
+    assert read_sheet(image, empty_question) == ('X', [], [], ['X'])
@@ -0,0 +1,113 @@
+import os
+import sys
+import csv
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from disc_v7 import RollnoCheck, compare_files, compare_frames, pair_rows, rollno_key  # noqa: E402
+
+COLUMNS = ['QPSERIES'] + [f'A{i}' for i in range(1, 21)]
+
+
+# Reference: the original row loop, on frames sorted by ROLLNO and checked to hold the same ROLLNOs
+def row_loop(df1, df2, columns):
+    df1 = df1.sort_values(by='ROLLNO', kind='stable')
+    df2 = df2.sort_values(by='ROLLNO', kind='stable')
+    discrepancies = []
+    for idx in range(len(df1)):
+        row1 = df1.iloc[idx]
+        row2 = df2.iloc[idx]
+        for col in columns:
+            if row1[col] != row2[col]:
+                discrepancies.append((row1['ROLLNO'], col, row1[col], row2[col], row1['Front side Image']))
+    return discrepancies
+
+
+def results(rollnos, rng, empty=0.02):
+    answers = rng.choice(np.array(list('ABCD*X'), dtype=object), (len(rollnos), len(COLUMNS)))
+    answers[rng.random(answers.shape) < empty] = np.nan
+    df = pd.DataFrame(answers, columns=COLUMNS)
+    df.insert(0, 'ROLLNO', rollnos)
+    df['Front side Image'] = [f'{rollno}F.jpg' for rollno in rollnos]
+    return df
+
+
+def altered(df, rng, share=0.05):
+    df = df.copy()
+    changes = rng.random((len(df), len(COLUMNS))) < share
+    values = df[COLUMNS].to_numpy(dtype=object)
+    values[changes] = rng.choice(np.array(list('ABCD'), dtype=object), int(changes.sum()))
+    df[COLUMNS] = values
+    return df.drop(columns=['Front side Image']).sample(frac=1, random_state=0)
+
+
+def test_rollno_key():
+    keys = rollno_key(pd.Series(['0123', '123', '000', '12A', '0012A']))
+    assert list(keys) == ['123', '123', '0', '12A', '0012A']
+
+
+def test_pair_rows_matches_leading_zeros_and_repeats_in_file_order():
+    df1 = pd.DataFrame({'ROLLNO': ['0123', '7', '7', '99']})
+    df2 = pd.DataFrame({'ROLLNO': ['7', '123', '7']})
+    rows1, rows2 = pair_rows(df1, df2)
+    assert list(zip(rows1, rows2)) == [(0, 1), (1, 0), (2, 2)]
+
+
+def test_rollno_check():
+    check = RollnoCheck()
+    check.add(pd.Series(['1', '02', '02', '3A']), pd.Series(['1', '2', '2', '4']))
+    assert check.missing == ['3A'] and check.extra == ['4']
+    # Both files show a ROLLNO as it was first written
+    assert check.duplicates == ({'02': 2}, {'02': 2})
+    assert check.suffixes == ({'A'}, set())
+    with pytest.raises(ValueError, match='do not match'):
+        check.check()
+    assert [title for title, message in check.warnings()] == ['Duplicates Found', 'Suffixes Found']
+
+
+def test_rollno_check_by_partition_matches_whole_files():
+    rng = np.random.default_rng(1)
+    rollnos1 = pd.Series(rng.integers(0, 300, 500).astype(str))
+    rollnos2 = pd.Series(rng.integers(0, 300, 500).astype(str))
+    whole = RollnoCheck()
+    whole.add(rollnos1, rollnos2)
+    parts = RollnoCheck()
+    for part in range(3):
+        parts.add(rollnos1[rollnos1.astype(int) % 3 == part], rollnos2[rollnos2.astype(int) % 3 == part])
+    assert sorted(whole.missing) == sorted(parts.missing) and sorted(whole.extra) == sorted(parts.extra)
+    assert whole.duplicates == parts.duplicates
+    assert whole.warnings() == parts.warnings()
+
+
+def test_compare_frames_matches_row_loop():
+    rng = np.random.default_rng(0)
+    df1 = results([f'{number:05d}' for number in rng.permutation(400)], rng)
+    df2 = altered(df1, rng)
+    mismatches = compare_frames(df1, df2, COLUMNS)
+    assert list(mismatches.itertuples(index=False, name=None)) == row_loop(df1, df2, COLUMNS)
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return sorted(csv.reader(f))
+
+
+def test_compare_chunked_matches_in_memory(tmp_path):
+    rng = np.random.default_rng(2)
+    df1 = results([str(number) for number in rng.permutation(6000)], rng)
+    df2 = altered(df1, rng)
+    # Excel dropped the leading zeros of some IP ROLLNOs
+    df1.loc[:99, 'ROLLNO'] = '00' + df1.loc[:99, 'ROLLNO']
+    df1.to_csv(tmp_path / 'scanned.csv', index=False)
+    df2.to_csv(tmp_path / 'ip.csv', index=False)
+
+    in_memory = compare_files(str(tmp_path / 'scanned.csv'), str(tmp_path / 'ip.csv'), str(tmp_path / 'memory.csv'),
+                              include_qpseries=True)
+    chunked = compare_files(str(tmp_path / 'scanned.csv'), str(tmp_path / 'ip.csv'), str(tmp_path / 'chunked.csv'),
+                            include_qpseries=True, memory_mb=1)
+    assert in_memory == chunked
+    assert in_memory['discrepancies'] > 0 and in_memory['qpseries'] > 0
+    for suffix in ('', '_qpseries', '_counts'):
+        assert read_rows(tmp_path / f'memory{suffix}.csv') == read_rows(tmp_path / f'chunked{suffix}.csv')
@@ -0,0 +1,60 @@
+import os
+import sys
+import csv
+import json
+import shutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from manifest import ImageManifest, MANIFEST_FILE, file_signature  # noqa: E402
+from scan import OMRScanner  # noqa: E402
+
+
+def test_record_after_torn_line_survives(tmp_path):
+    image_path = str(tmp_path / 'p1F.jpg')
+    manifest = ImageManifest(str(tmp_path))
+    manifest.record(str(tmp_path / 'p0F.jpg'), note='before')
+    manifest.close()
+    # An interrupted run left half a line behind
+    with open(tmp_path / MANIFEST_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"image": "p0F.jpg", "scan')
+
+    manifest = ImageManifest(str(tmp_path))
+    manifest.record(image_path, note='after-crash')
+    manifest.close()
+
+    manifest = ImageManifest(str(tmp_path))
+    assert manifest.get(image_path)['note'] == 'after-crash'
+    assert manifest.get(str(tmp_path / 'p0F.jpg'))['note'] == 'before'
+
+
+def test_row_reused_only_with_same_template(tmp_path):
+    image_path = str(tmp_path / 'p0F.jpg')
+    (tmp_path / 'p0F.jpg').write_bytes(b'sheet')
+    manifest = ImageManifest(str(tmp_path))
+    manifest.record(image_path, scanned=file_signature(image_path), template='a', row=['1', '2', 'A'])
+    assert manifest.scanned_row(image_path, 'a') == ['1', '2', 'A']
+    assert manifest.scanned_row(image_path, 'b') is None
+    # Rows recorded before templates were fingerprinted are decoded again
+    manifest.record(image_path, template=None)
+    assert manifest.scanned_row(image_path, 'a') is None
+
+
+def test_rescan_after_template_edit(tmp_path):
+    image_dir = tmp_path / 'sheets'
+    image_dir.mkdir()
+    shutil.copy(os.path.join(ROOT, '2024.07.18 12.29.42F.jpg'), image_dir / 'p0F.jpg')
+    with open(os.path.join(ROOT, 'jssc.gs')) as f:
+        template = json.load(f)
+    template['question_regions'] = template['question_regions'][:100]
+    short_template = tmp_path / 'short.gs'
+    short_template.write_text(json.dumps(template))
+
+    output_csv = str(tmp_path / 'out.csv')
+    OMRScanner(os.path.join(ROOT, 'jssc.gs'), str(image_dir), output_csv, fills=True).scan_images()
+    scanner = OMRScanner(str(short_template), str(image_dir), output_csv, fills=True)
+    scanner.scan_images()
+    assert scanner.cached_rows == {}
+    with open(output_csv, newline='') as f:
+        rows = list(csv.reader(f))
+    assert [len(row) for row in rows] == [104, 104]
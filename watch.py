@@ -0,0 +1,296 @@
+import os
+import sys
+import csv
+import base64
+import time
+import queue
+import argparse
+import multiprocessing
+import cv2
+from manifest import ImageManifest, file_signature
+from align import REJECT_FILE, ALIGNMENT_MARKER, adopt_marker, find_image_files, write_rejects, add_aligner_arguments, aligner_from_args
+from scan import (TemplateLayout, CsvStreamWriter, scan_file, csv_header, response_row, init_worker, scan_worker,
+                  sidecar_paths, remove_files)
+from pipeline import folder_name
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    # Optional; without it the base directory is polled
+    Observer = None
+
+
+def is_sheet(path):
+    return path.lower().endswith('f.jpg')
+
+
+def jpeg_complete(path):
+    # A JPEG still being copied has not reached its end-of-image marker yet
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b'\xff\xd9'
+    except OSError:
+        return False
+
+
+class EventQueue:
+    # watchdog handler; dispatch() is called on the observer thread for every file-system event
+    def __init__(self, events):
+        self.events = events
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        # A sheet renamed into place only shows up as the destination of a move
+        path = getattr(event, 'dest_path', '') or event.src_path
+        if is_sheet(path):
+            self.events.put(path)
+
+
+class SheetWatcher:
+    # Long-running align + scan service for a scanner's drop folder. The template layout and the
+    # aligner (template features, matcher) are built once and stay warm, in this process or in a
+    # persistent worker pool, so each sheet costs only its own alignment and decode. A sheet is
+    # processed once its size and mtime have stopped changing for `settle` seconds and the JPEG is
+    # complete. Its row is appended to <folder>/<folder>.csv and recorded in the folder manifest, so
+    # pipeline.py and scan.py see the sheet as done.
+    def __init__(self, base_dir, template_file, aligner=None, workers=1, write_aligned=True, settle=2.0,
+                 poll_interval=5.0, use_watchdog=True):
+        self.base_dir = os.path.abspath(base_dir)
+        self.layout = TemplateLayout.load(template_file)
+        self.header = csv_header(self.layout)
+        self.aligner = aligner
+        self.write_aligned = write_aligned
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.use_watchdog = use_watchdog and Observer is not None
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, init_worker, (self.layout, aligner, write_aligned, None))
+        self.events = queue.Queue()
+        self.candidates = {}
+        self.failed = {}
+        self.manifests = {}
+        # Folders whose CSV holds exactly the manifest's rows. Until a folder's first write, its CSV
+        # may come from a failed write, an earlier template or a scan from before the manifest.
+        self.synced = set()
+
+    def folder_of(self, image_path):
+        # Sheets belong to the top-level subfolder they were dropped into, or to base_dir itself
+        parts = os.path.relpath(image_path, self.base_dir).split(os.sep)
+        if len(parts) > 1:
+            return os.path.join(self.base_dir, parts[0])
+        return self.base_dir
+
+    def manifest_for(self, folder):
+        if folder not in self.manifests:
+            manifest = ImageManifest(folder)
+            if self.aligner is not None:
+                # As in pipeline.py, a folder aligned before the manifest existed is not aligned again
+                image_files = [image_path for image_path in find_image_files(folder)
+                               if self.folder_of(os.path.abspath(image_path)) == folder]
+                adopt_marker(manifest, image_files, os.path.join(folder, ALIGNMENT_MARKER))
+            self.manifests[folder] = manifest
+        return self.manifests[folder]
+
+    def output_csv(self, folder):
+        return os.path.join(folder, f'{folder_name(folder)}.csv')
+
+    def is_done(self, image_path, signature):
+        # Scanned, rejected or failed to align, and unchanged since
+        manifest = self.manifest_for(self.folder_of(image_path))
+        if manifest.is_scanned(image_path, self.layout.fingerprint, signature):
+            return True
+        entry = manifest.get(image_path)
+        if entry.get('align_status') == 'rejected' and entry.get('rejected') == signature:
+            return True
+        return self.failed.get(image_path) == signature
+
+    def sweep(self):
+        for image_path in find_image_files(self.base_dir):
+            self.events.put(image_path)
+
+    def collect(self):
+        now = time.monotonic()
+        while True:
+            try:
+                image_path = self.events.get_nowait()
+            except queue.Empty:
+                break
+            image_path = os.path.abspath(image_path)
+            try:
+                signature = file_signature(image_path)
+            except OSError:
+                # Deleted or moved away again
+                self.candidates.pop(image_path, None)
+                continue
+            if self.is_done(image_path, signature):
+                self.candidates.pop(image_path, None)
+            elif self.candidates.get(image_path, (None,))[0] != signature:
+                self.candidates[image_path] = (signature, now)
+
+    def ready(self):
+        # Candidates whose size and mtime held still for `settle` seconds. A JPEG without its
+        # end-of-image marker waits longer, in case the copy has only stalled.
+        now = time.monotonic()
+        ready = []
+        for image_path, (signature, since) in list(self.candidates.items()):
+            try:
+                current = file_signature(image_path)
+            except OSError:
+                del self.candidates[image_path]
+                continue
+            if current != signature:
+                self.candidates[image_path] = (current, now)
+                continue
+            waited = now - since
+            if current[0] > 0 and waited >= self.settle and (jpeg_complete(image_path) or waited >= 10 * self.settle):
+                del self.candidates[image_path]
+                ready.append(image_path)
+        return sorted(ready)
+
+    def process(self, image_paths):
+        tasks = []
+        for image_path in image_paths:
+            manifest = self.manifest_for(self.folder_of(image_path))
+            tasks.append((image_path, self.aligner is not None and not manifest.is_aligned(image_path)))
+        if self.pool is not None:
+            outcomes = [self.pool.apply_async(scan_worker, (task,)) for task in tasks]
+        for index, (image_path, needs_alignment) in enumerate(tasks):
+            # A sheet that vanished, or could not be read or written, must not stop the service
+            try:
+                if self.pool is not None:
+                    result = outcomes[index].get()
+                else:
+                    result = scan_file(image_path, self.layout, aligner=self.aligner if needs_alignment else None,
+                                       write_aligned=self.write_aligned)
+                self.record(*result)
+            except (OSError, cv2.error) as e:
+                print(f"Failed to process {image_path}: {e}")
+                self.mark_failed(image_path)
+
+    def mark_failed(self, image_path):
+        # Not retried until the file changes; a file that is gone needs nothing
+        try:
+            self.failed[image_path] = file_signature(image_path)
+        except OSError:
+            self.failed.pop(image_path, None)
+
+    def record(self, image_path, responses, status, fills):
+        folder = self.folder_of(image_path)
+        manifest = self.manifest_for(folder)
+        if status == 'unreadable':
+            print(f"Failed to load image: {image_path}")
+            self.mark_failed(image_path)
+            return
+        if status == 'unaligned':
+            print(f"Failed to align image: {image_path}")
+            manifest.record(image_path, align_status='failed')
+            self.mark_failed(image_path)
+            return
+        if status == 'rejected':
+            reason, quality = responses
+            print(f"Rejected image: {image_path} ({reason})")
+            manifest.record(image_path, rejected=file_signature(image_path), align_status='rejected',
+                            reject_reason=reason, **quality)
+            write_rejects(manifest, os.path.join(folder, REJECT_FILE))
+            return
+        if status == 'written':
+            manifest.record(image_path, aligned=file_signature(image_path), align_status='ok')
+        # A sheet replaced after it was scanned already has a row in the CSV
+        rescanned = manifest.get(image_path).get('row') is not None
+        row = response_row(responses)
+        # The fill ratios come free with the decode; keeping them lets scan.py --fills reuse the row
+        manifest.record(image_path, scanned=file_signature(image_path), template=self.layout.fingerprint, row=row,
+                        fills=base64.b64encode(fills.tobytes()).decode('ascii'))
+        stale = rescanned or folder not in self.synced
+        self.synced.discard(folder)
+        # The --fills and --columnar files of a scan.py run do not follow the CSV as it grows
+        remove_files(sidecar_paths(self.output_csv(folder)))
+        if stale:
+            self.rebuild_csv(folder)
+        else:
+            self.append_row(folder, row + [image_path])
+        self.synced.add(folder)
+        print(f"Processed: {os.path.basename(image_path)} - ROLLNO: {row[0]}, QBNO: {row[1]}, QPSERIES: {row[2]}")
+
+    def append_row(self, folder, row):
+        output_csv = self.output_csv(folder)
+        new_file = not os.path.exists(output_csv)
+        with open(output_csv, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(self.header)
+            writer.writerow(row)
+
+    def rebuild_csv(self, folder):
+        # Rewrites the CSV from the manifest, in path order, as scan.py would
+        manifest = self.manifest_for(folder)
+        with CsvStreamWriter(self.output_csv(folder), self.header) as writer:
+            for image_path in sorted(find_image_files(folder)):
+                row = manifest.scanned_row(image_path, self.layout.fingerprint)
+                if row is not None:
+                    writer.writerow(row + [image_path])
+
+    def run(self, once=False):
+        # With once, exits when every sheet already on disk is done instead of watching for more
+        observer = None
+        if self.use_watchdog and not once:
+            observer = Observer()
+            observer.schedule(EventQueue(self.events), self.base_dir, recursive=True)
+            observer.start()
+            print(f"Watching {self.base_dir} for new sheets")
+        elif not once:
+            print(f"Polling {self.base_dir} for new sheets every {self.poll_interval:g} s")
+        last_sweep = time.monotonic()
+        self.sweep()
+        try:
+            while True:
+                if observer is None and not once and time.monotonic() - last_sweep >= self.poll_interval:
+                    last_sweep = time.monotonic()
+                    self.sweep()
+                self.collect()
+                image_paths = self.ready()
+                if image_paths:
+                    self.process(image_paths)
+                    for manifest in self.manifests.values():
+                        manifest.close()
+                elif once and not self.candidates:
+                    break
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("Stopping")
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            if self.pool is not None:
+                self.pool.terminate()
+            for manifest in self.manifests.values():
+                manifest.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Align and scan OMR sheets as they arrive under a directory.')
+    parser.add_argument('base_dir')
+    parser.add_argument('template_file')
+    parser.add_argument('--align', metavar='TEMPLATE_IMAGE', help='align each new sheet to this image before decoding it')
+    parser.add_argument('--workers', type=int, default=1, help='processes kept running for bursts of sheets (default: 1)')
+    add_aligner_arguments(parser)
+    parser.add_argument('--keep-originals', action='store_true', help='do not write aligned sheets back over the originals')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must stay the same size before it is read (default: 2)')
+    parser.add_argument('--poll-interval', type=float, default=5.0,
+                        help='seconds between directory scans when watchdog is not installed (default: 5)')
+    parser.add_argument('--poll', action='store_true', help='poll even if watchdog is installed (e.g. for network shares)')
+    parser.add_argument('--once', action='store_true', help='process the sheets already there and exit')
+    args = parser.parse_args()
+    try:
+        aligner = aligner_from_args(args, args.align) if args.align else None
+        watcher = SheetWatcher(args.base_dir, args.template_file, aligner, args.workers, not args.keep_originals,
+                               args.settle, args.poll_interval, not args.poll)
+        watcher.run(args.once)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)